@@ -0,0 +1,84 @@
+import copy
+import time
+import resource
+import yaml
+import torch
+import torch.multiprocessing as mp
+from argparse import ArgumentParser
+from model import AE
+from benchmarks.common import train_step
+from utils import cc
+from utils import ActivationMemory
+
+# name: config['checkpointing']
+settings = {
+    'none': {},
+    'every_2': {'SpeakerEncoder': 2, 'ContentEncoder': 2, 'Decoder': 2},
+    'all': {'SpeakerEncoder': 1, 'ContentEncoder': 1, 'Decoder': 1},
+    'all+bank': {'SpeakerEncoder': 1, 'ContentEncoder': 1, 'Decoder': 1, 'conv_bank': True},
+}
+
+def max_rss():
+    # peak resident memory of this process in bytes (ru_maxrss is in KB on linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def worker(name, args, config, results):
+    # a fresh process for every setting, the peak resident memory of a process never goes down
+    torch.set_num_threads(args.n_threads)
+    config = copy.deepcopy(config)
+    config['checkpointing'] = settings[name]
+    torch.manual_seed(0)
+    model = cc(AE(config))
+    opt = torch.optim.Adam(model.parameters(), lr=config['optimizer']['lr'])
+    x = cc(torch.randn(args.batch_size, config['SpeakerEncoder']['c_in'], args.segment_size))
+    with ActivationMemory() as memory:
+        model(x)
+    # the first step allocates the gradients and the optimizer state, count those too
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+    else:
+        base = max_rss()
+    train_step(model, opt, x, config)
+    for _ in range(args.warmup):
+        train_step(model, opt, x, config)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated() - base
+    else:
+        peak = max_rss() - base
+    step_times = []
+    for _ in range(args.iters):
+        start_time = time.time()
+        train_step(model, opt, x, config)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        step_times.append(time.time() - start_time)
+    step_time = sorted(step_times)[len(step_times) // 2]
+    results[name] = (step_time, peak, memory.bytes)
+
+if __name__ == '__main__':
+    # python3 -m benchmarks.checkpointing -c config.yaml -batch_size 32 -segment_size 256
+    parser = ArgumentParser()
+    parser.add_argument('-config', '-c', default='config.yaml')
+    parser.add_argument('-settings', nargs='+', default=list(settings), choices=list(settings))
+    parser.add_argument('-batch_size', default=32, type=int)
+    parser.add_argument('-segment_size', default=128, type=int)
+    parser.add_argument('-iters', default=5, type=int)
+    parser.add_argument('-warmup', default=1, type=int)
+    parser.add_argument('-n_threads', default=torch.get_num_threads(), type=int)
+    args = parser.parse_args()
+    with open(args.config) as f:
+        config = yaml.safe_load(f)
+    ctx = mp.get_context('spawn')
+    results = ctx.Manager().dict()
+    for name in args.settings:
+        process = ctx.Process(target=worker, args=(name, args, config, results))
+        process.start()
+        process.join()
+        step_time, peak, activation_bytes = results[name]
+        first_time, first_peak = results[args.settings[0]][:2]
+        print(f'{name}: {step_time * 1000:.1f} ms/step, peak={peak / 2 ** 20:.1f} MB '
+                f'({peak / first_peak:.2f}x), saved activations={activation_bytes / 2 ** 20:.1f} MB, '
+                f'recompute overhead={step_time / first_time - 1:+.1%}')
@@ -0,0 +1,18 @@
+import torch
+from solver import vae_losses
+from utils import get_grad_scaler
+
+def train_step(model, opt, x, config, scaler=None, device_type='cpu', dtype=torch.float32):
+    # one step of Solver.ae_step on a full batch, with the kl weight after annealing
+    if scaler is None:
+        scaler = get_grad_scaler(enabled=False)
+    with torch.autocast(device_type=device_type, dtype=dtype, enabled=dtype != torch.float32):
+        mu, log_sigma, emb, dec = model(x)
+    loss_rec, loss_kl = vae_losses(x, mu, log_sigma, dec)
+    loss = config['lambda']['lambda_rec'] * loss_rec + config['lambda']['lambda_kl'] * loss_kl
+    opt.zero_grad()
+    scaler.scale(loss).backward()
+    scaler.unscale_(opt)
+    torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=config['optimizer']['grad_norm'])
+    scaler.step(opt)
+    scaler.update()
@@ -0,0 +1,60 @@
+import os
+import time
+import yaml
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from argparse import ArgumentParser
+from torch.nn.parallel import DistributedDataParallel
+from model import AE
+from benchmarks.common import train_step
+
+def worker(rank, world_size, args, config, results):
+    torch.set_num_threads(max(1, os.cpu_count() // world_size))
+    dist.init_process_group('gloo', init_method='env://', rank=rank, world_size=world_size)
+    # different initialization on every rank, DistributedDataParallel broadcasts the one of rank 0
+    torch.manual_seed(rank)
+    model = DistributedDataParallel(AE(config))
+    opt = torch.optim.Adam(model.parameters(), lr=config['optimizer']['lr'])
+    x = torch.randn(args.batch_size, config['SpeakerEncoder']['c_in'], args.segment_size)
+    for _ in range(args.warmup):
+        train_step(model, opt, x, config)
+    dist.barrier()
+    start_time = time.time()
+    for _ in range(args.iters):
+        train_step(model, opt, x, config)
+    dist.barrier()
+    elapsed = time.time() - start_time
+    # the replicas must still be identical after the updates
+    checksum = torch.stack([p.detach().double().sum() for p in model.parameters()]).sum()
+    checksums = [torch.zeros_like(checksum) for _ in range(world_size)]
+    dist.all_gather(checksums, checksum)
+    if rank == 0:
+        results[world_size] = (elapsed, max(abs(c - checksums[0]).item() for c in checksums))
+    dist.destroy_process_group()
+
+if __name__ == '__main__':
+    # python3 -m benchmarks.distributed -c config.yaml -n_procs 1 2 4
+    parser = ArgumentParser()
+    parser.add_argument('-config', '-c', default='config.yaml')
+    parser.add_argument('-n_procs', nargs='+', default=[1, 2, 4], type=int)
+    parser.add_argument('-batch_size', default=16, type=int, help='per process')
+    parser.add_argument('-segment_size', default=128, type=int)
+    parser.add_argument('-iters', default=10, type=int)
+    parser.add_argument('-warmup', default=2, type=int)
+    parser.add_argument('-master_port', default='29501')
+    args = parser.parse_args()
+    with open(args.config) as f:
+        config = yaml.safe_load(f)
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', args.master_port)
+    results = mp.Manager().dict()
+    for n_procs in args.n_procs:
+        mp.spawn(worker, args=(n_procs, args, config, results), nprocs=n_procs)
+        elapsed, max_diff = results[n_procs]
+        throughput = n_procs * args.batch_size * args.iters / elapsed
+        base = results[args.n_procs[0]]
+        base_throughput = args.n_procs[0] * args.batch_size * args.iters / base[0]
+        print(f'{n_procs} procs: {throughput:.1f} segments/s, '
+                f'scaling efficiency={throughput / base_throughput * args.n_procs[0] / n_procs:.2f}, '
+                f'max parameter difference between ranks={max_diff:.1e}')
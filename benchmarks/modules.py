@@ -0,0 +1,116 @@
+import json
+import time
+import yaml
+import torch
+import numpy as np
+from argparse import ArgumentParser
+from functools import reduce
+from model import AE
+from model import SpeakerEncoder
+from model import ContentEncoder
+from model import Decoder
+from utils import cc
+from utils import ActivationMemory
+
+def flatten_outputs(out):
+    if isinstance(out, tuple):
+        return sum(o.float().sum() for o in out)
+    return out.float().sum()
+
+def synchronize():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+def build_modules(config, batch_size, segment_size):
+    # (name, module, inputs)
+    total_subsample = reduce(lambda x, y: x*y, config['ContentEncoder']['subsample'])
+    x = torch.randn(batch_size, config['SpeakerEncoder']['c_in'], segment_size)
+    z = torch.randn(batch_size, config['Decoder']['c_in'], segment_size // total_subsample)
+    cond = torch.randn(batch_size, config['Decoder']['c_cond'])
+    return [('SpeakerEncoder', SpeakerEncoder(**config['SpeakerEncoder']), (x,)),
+            ('ContentEncoder', ContentEncoder(**config['ContentEncoder']), (x,)),
+            ('Decoder', Decoder(**config['Decoder']), (z, cond)),
+            ('AE', AE(config), (x,))]
+
+def count_flops(module, inputs):
+    # forward flops, None if this torch has no flop counter
+    try:
+        from torch.utils.flop_counter import FlopCounterMode
+    except ImportError:
+        return None
+    with FlopCounterMode(display=False) as counter:
+        with torch.no_grad():
+            module(*inputs)
+    return counter.get_total_flops()
+
+def benchmark_module(module, inputs, n_iters, n_warmup):
+    module = cc(module)
+    module.train()
+    inputs = [cc(inp) for inp in inputs]
+    for _ in range(n_warmup):
+        flatten_outputs(module(*inputs)).backward()
+    forward_times, backward_times = [], []
+    for _ in range(n_iters):
+        module.zero_grad()
+        synchronize()
+        start_time = time.time()
+        loss = flatten_outputs(module(*inputs))
+        synchronize()
+        forward_times.append(time.time() - start_time)
+        start_time = time.time()
+        loss.backward()
+        synchronize()
+        backward_times.append(time.time() - start_time)
+    n_params = sum(p.numel() for p in module.parameters())
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+        flatten_outputs(module(*inputs)).backward()
+        peak_memory = torch.cuda.max_memory_allocated()
+    else:
+        # parameters + gradients + activations saved for backward
+        with ActivationMemory() as memory:
+            loss = flatten_outputs(module(*inputs))
+        loss.backward()
+        peak_memory = memory.bytes + 2 * sum(p.numel() * p.element_size() for p in module.parameters())
+    result = {'forward_ms': float(np.median(forward_times) * 1000), 
+            'backward_ms': float(np.median(backward_times) * 1000), 
+            'peak_memory_mb': peak_memory / 2 ** 20, 
+            'n_params': n_params, 
+            'forward_flops': count_flops(module, inputs)}
+    return result
+
+if __name__ == '__main__':
+    # python3 -m benchmarks.modules -configs config.yaml -output benchmark.json
+    parser = ArgumentParser()
+    parser.add_argument('-configs', nargs='+', default=['config.yaml'])
+    parser.add_argument('-batch_sizes', nargs='+', default=[1, 16, 64], type=int)
+    parser.add_argument('-segment_sizes', nargs='+', default=[128, 256], type=int)
+    parser.add_argument('-modules', nargs='+', default=['SpeakerEncoder', 'ContentEncoder', 'Decoder', 'AE'])
+    parser.add_argument('-iters', default=5, type=int)
+    parser.add_argument('-warmup', default=1, type=int)
+    parser.add_argument('-threads', default=0, type=int, help='torch threads, 0 for the default')
+    parser.add_argument('-output', '-o', default='benchmark.json')
+    args = parser.parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    results = []
+    for config_path in args.configs:
+        with open(config_path) as f:
+            config = yaml.safe_load(f)
+        for batch_size in args.batch_sizes:
+            for segment_size in args.segment_sizes:
+                for name, module, inputs in build_modules(config, batch_size, segment_size):
+                    if name not in args.modules:
+                        continue
+                    result = benchmark_module(module, inputs, args.iters, args.warmup)
+                    result.update({'config': config_path, 'module': name, 
+                        'batch_size': batch_size, 'segment_size': segment_size})
+                    results.append(result)
+                    print(f'{config_path} {name} batch={batch_size} segment={segment_size}: '
+                            f'forward={result["forward_ms"]:.1f}ms backward={result["backward_ms"]:.1f}ms '
+                            f'memory={result["peak_memory_mb"]:.1f}MB params={result["n_params"]}')
+    with open(args.output, 'w') as f:
+        json.dump({'device': 'cuda' if torch.cuda.is_available() else 'cpu', 
+            'torch': torch.__version__, 
+            'threads': torch.get_num_threads(), 
+            'results': results}, f, indent=2)
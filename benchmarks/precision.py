@@ -0,0 +1,52 @@
+import time
+import yaml
+import torch
+from argparse import ArgumentParser
+from model import AE
+from benchmarks.common import train_step
+from utils import cc
+from utils import get_grad_scaler
+from utils import ActivationMemory
+
+def benchmark(config, precision, batch_size, segment_size, n_iters, n_warmup):
+    device_type = 'cuda' if torch.cuda.is_available() else 'cpu'
+    dtype = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}[precision]
+    model = cc(AE(config))
+    opt = torch.optim.Adam(model.parameters(), lr=config['optimizer']['lr'])
+    scaler = get_grad_scaler(enabled=precision == 'fp16')
+    x = cc(torch.randn(batch_size, config['SpeakerEncoder']['c_in'], segment_size))
+    for _ in range(n_warmup):
+        train_step(model, opt, x, config, scaler, device_type, dtype)
+    with torch.autocast(device_type=device_type, dtype=dtype, enabled=dtype != torch.float32):
+        with ActivationMemory() as memory:
+            model(x)
+    if device_type == 'cuda':
+        torch.cuda.synchronize()
+    start_time = time.time()
+    for _ in range(n_iters):
+        train_step(model, opt, x, config, scaler, device_type, dtype)
+    if device_type == 'cuda':
+        torch.cuda.synchronize()
+    step_time = (time.time() - start_time) / n_iters
+    return step_time, memory.bytes
+
+if __name__ == '__main__':
+    # python3 -m benchmarks.precision -c config.yaml
+    parser = ArgumentParser()
+    parser.add_argument('-config', '-c', default='config.yaml')
+    parser.add_argument('-precisions', nargs='+', default=['fp32', 'bf16'])
+    parser.add_argument('-batch_size', default=32, type=int)
+    parser.add_argument('-segment_size', default=128, type=int)
+    parser.add_argument('-iters', default=10, type=int)
+    parser.add_argument('-warmup', default=2, type=int)
+    args = parser.parse_args()
+    with open(args.config) as f:
+        config = yaml.safe_load(f)
+    results = {}
+    for precision in args.precisions:
+        step_time, activation_bytes = benchmark(config, precision, args.batch_size, 
+                args.segment_size, args.iters, args.warmup)
+        results[precision] = step_time
+        print(f'{precision}: {step_time * 1000:.1f} ms/step, {args.batch_size / step_time:.1f} segments/s, '
+                f'activations={activation_bytes / 2 ** 20:.1f} MB, '
+                f'speedup={results[args.precisions[0]] / step_time:.2f}x')
@@ -0,0 +1,47 @@
+import os
+import sys
+import time
+import subprocess
+import numpy as np
+from argparse import ArgumentParser
+
+HEAVY_MODULES = ['scipy', 'librosa', 'numba', 'tensorboardX', 'editdistance', 'tensorflow', 'onnxruntime']
+
+def run(command):
+    start_time = time.time()
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    return time.time() - start_time
+
+def imported_modules(module):
+    out = subprocess.run([sys.executable, '-c', 
+        f'import sys, {module}; print(" ".join(m for m in {HEAVY_MODULES} if m in sys.modules))'],
+        check=True, capture_output=True, text=True).stdout
+    return out.split()
+
+if __name__ == '__main__':
+    # python3 -m benchmarks.startup -c config.yaml -m model.ckpt -a attr.pkl -s src.wav -t tar.wav
+    # wall time of fresh processes: importing inference.py and converting one file (until the wav is written)
+    parser = ArgumentParser()
+    parser.add_argument('-config', '-c', default='config.yaml')
+    parser.add_argument('-model', '-m', help='model path')
+    parser.add_argument('-exported', default='', help='model.pt or model.onnx of export.py instead of -model')
+    parser.add_argument('-attr', '-a', help='attr file path')
+    parser.add_argument('-source', '-s', help='source wav path')
+    parser.add_argument('-target', '-t', help='target wav path')
+    parser.add_argument('-output', '-o', default='startup_benchmark.wav')
+    parser.add_argument('-n_iter', default=32, type=int)
+    parser.add_argument('-runs', default=5, type=int)
+    args = parser.parse_args()
+    print(f'heavy modules loaded by import inference: {imported_modules("inference")}')
+    import_times = [run([sys.executable, '-c', 'import inference']) for _ in range(args.runs)]
+    command = [sys.executable, 'inference.py', '-c', args.config, '-a', args.attr, 
+            '-s', args.source, '-t', args.target, '-o', args.output, '-n_iter', str(args.n_iter)]
+    command += ['-exported', args.exported] if args.exported else ['-m', args.model]
+    convert_times = []
+    for _ in range(args.runs):
+        if os.path.exists(args.output):
+            os.remove(args.output)
+        convert_times.append(run(command))
+        assert os.path.exists(args.output)
+    for name, times in [('import inference', import_times), ('first converted wav', convert_times)]:
+        print(f'{name}: median={np.median(times):.2f}s min={np.min(times):.2f}s over {args.runs} runs')
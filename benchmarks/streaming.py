@@ -0,0 +1,61 @@
+import time
+import yaml
+import torch
+import numpy as np
+from argparse import ArgumentParser
+from model import AE
+from streaming import StreamingConverter
+from preprocess.tacotron.hyperparams import Hyperparams as hp
+from preprocess.tacotron.audio import load_wav
+
+if __name__ == '__main__':
+    # python3 -m benchmarks.streaming -c config.yaml -m model.ckpt -s src.wav -block_frames 8 16 32
+    # feeds the source as a live stream in blocks of -input_block samples. a block is in time if its
+    # processing time stays below its duration, the latency of a sample is the algorithmic latency
+    # plus the processing time of the block it leaves in
+    parser = ArgumentParser()
+    parser.add_argument('-config', '-c', default='config.yaml')
+    parser.add_argument('-model', '-m', default='', help='model path, random weights if empty')
+    parser.add_argument('-source', '-s', default='', help='source wav, white noise if empty')
+    parser.add_argument('-duration', default=10., type=float, help='seconds of noise without -source')
+    parser.add_argument('-block_frames', default=[8, 16, 32], type=int, nargs='+')
+    parser.add_argument('-lookahead', default=16, type=int)
+    parser.add_argument('-input_block', default=480, type=int, help='samples per process() call')
+    parser.add_argument('-n_iter', default=16, type=int)
+    parser.add_argument('-n_threads', default=1, type=int)
+    args = parser.parse_args()
+    torch.set_num_threads(args.n_threads)
+    with open(args.config) as f:
+        config = yaml.safe_load(f)
+    model = AE(config)
+    if args.model:
+        model.load_state_dict(torch.load(args.model, map_location='cpu'))
+    model.eval()
+    if args.source:
+        y = load_wav(args.source, hp.sr)
+    else:
+        y = np.random.default_rng(0).normal(0, 0.1, int(args.duration * hp.sr)).astype(np.float32)
+    attr = {'mean': np.zeros(config['SpeakerEncoder']['c_in'], dtype=np.float32),
+            'std': np.ones(config['SpeakerEncoder']['c_in'], dtype=np.float32)}
+    with torch.no_grad():
+        emb = model.get_speaker_embeddings(torch.randn(1, config['SpeakerEncoder']['c_in'], 128))
+    for block_frames in args.block_frames:
+        converter = StreamingConverter(model, config, attr, emb, block_frames=block_frames,
+                lookahead=args.lookahead, n_iter=args.n_iter, momentum=0.99)
+        # warm up
+        converter.process(y[:converter.latency_samples + converter.block_samples])
+        converter.reset()
+        times = []
+        for i in range(0, len(y), args.input_block):
+            start_time = time.time()
+            out = converter.process(y[i:i + args.input_block])
+            if len(out) > 0:
+                times.append(time.time() - start_time)
+        times = np.array(times) * 1000
+        block_ms = converter.block_samples / hp.sr * 1000
+        print(f'block={converter.block_frames} frames ({block_ms:.1f}ms), lookahead={converter.lookahead} frames: '
+                f'algorithmic latency={converter.latency * 1000:.1f}ms, '
+                f'processing p50={np.percentile(times, 50):.1f}ms p99={np.percentile(times, 99):.1f}ms '
+                f'max={np.max(times):.1f}ms, real-time factor={np.sum(times) / (len(y) / hp.sr * 1000):.3f}, '
+                f'late blocks={np.mean(times > block_ms) * 100:.1f}%, '
+                f'worst latency={converter.latency * 1000 + np.percentile(times, 99):.1f}ms')
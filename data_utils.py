@@ -1,8 +1,12 @@
 import torch
 from torch.utils.data import Dataset
+from torch.utils.data import IterableDataset
+from torch.utils.data import get_worker_info
+from torch.utils.data import Sampler
 import os 
 import pickle 
 import json
+from math import ceil
 import numpy as np
 import torch
 from torch.utils.data import DataLoader
@@ -21,12 +25,151 @@ class CollateFn(object):
         segment = self.make_frames(data_tensor)
         return segment
 
-def get_data_loader(dataset, batch_size, frame_size, shuffle=True, num_workers=4, drop_last=False):
+class PaddedCollateFn(CollateFn):
+    # utterances of different lengths, zero padded to the longest one, returns (segment, lengths)
+    def __call__(self, l):
+        lengths = [len(utt) for utt in l]
+        data = np.zeros((len(l), max(lengths), l[0].shape[1]), dtype=np.float32)
+        for i, utt in enumerate(l):
+            data[i, :len(utt)] = utt
+        segment = self.make_frames(torch.from_numpy(data))
+        return segment, torch.tensor(lengths, dtype=torch.long) // self.frame_size
+
+def get_data_loader(dataset, batch_size, frame_size, shuffle=True, num_workers=4, drop_last=False, sampler=None, 
+        batch_sampler=None, prefetch_factor=2, persistent_workers=False):
     _collate_fn = CollateFn(frame_size=frame_size) 
-    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, 
-            num_workers=num_workers, collate_fn=_collate_fn, pin_memory=True)
+    # the worker seeds come from their own generator instead of the global rng, 
+    # so restarting the loader does not shift the global rng stream saved in checkpoints
+    generator = torch.Generator()
+    # batches loaded in advance by each worker, persistent workers are kept alive between epochs
+    # (a new pass only resets the sampler). both need worker processes
+    worker_args = {'prefetch_factor': prefetch_factor, 'persistent_workers': persistent_workers} \
+            if num_workers > 0 else {}
+    if batch_sampler is not None:
+        # variable-length batches, e.g. BucketBatchSampler
+        dataloader = DataLoader(dataset, batch_sampler=batch_sampler, num_workers=num_workers, 
+                collate_fn=PaddedCollateFn(frame_size=frame_size), pin_memory=True, generator=generator, 
+                **worker_args)
+    elif isinstance(dataset, IterableDataset):
+        # the dataset yields whole batches
+        dataloader = DataLoader(dataset, batch_size=None, 
+                num_workers=num_workers, collate_fn=_collate_fn, pin_memory=True, generator=generator, 
+                **worker_args)
+    else:
+        # a sampler (e.g. DistributedSampler) does its own shuffling
+        dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=shuffle and sampler is None, 
+                sampler=sampler, num_workers=num_workers, collate_fn=_collate_fn, pin_memory=True, 
+                generator=generator, **worker_args)
     return dataloader
 
+class ResumableSampler(Sampler):
+    '''Shuffles every epoch with a generator seeded by seed + epoch, so an epoch can be replayed,
+    and splits the indices over num_replicas processes as DistributedSampler.
+    resume(n_batches) continues after the first n_batches batches of batch_size.
+    '''
+    def __init__(self, dataset, shuffle=True, seed=0, num_replicas=1, rank=0):
+        self.n_samples = len(dataset)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.num_samples = ceil(self.n_samples / num_replicas)
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.start = 0
+
+    def resume(self, n_batches, batch_size):
+        # the last batch of an epoch is smaller (drop_last=False)
+        batches_per_epoch = ceil(self.num_samples / batch_size)
+        self.epoch = n_batches // batches_per_epoch
+        self.start = (n_batches % batches_per_epoch) * batch_size
+
+    def __iter__(self):
+        if self.shuffle:
+            g = torch.Generator()
+            g.manual_seed(self.seed + self.epoch)
+            indices = torch.randperm(self.n_samples, generator=g).tolist()
+        else:
+            indices = list(range(self.n_samples))
+        # pad with the first indices to split evenly
+        total_size = self.num_samples * self.num_replicas
+        indices = (indices * ceil(total_size / self.n_samples))[:total_size]
+        indices = indices[self.rank:total_size:self.num_replicas]
+        return iter(indices[self.start:])
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+class BucketBatchSampler(Sampler):
+    '''Batches of whole utterances with similar lengths under a budget of max_tokens frames
+    (padding included) instead of a fixed batch size. Utterances longer than max_length are cut
+    at a random offset, every length is cut down to a multiple of `multiple` (the total 
+    subsampling of the model, so the padded batch gives the same result as the utterances alone) 
+    and utterances shorter than min_length are skipped.
+    Epoch e draws the offsets and the order of the batches with a generator seeded by (seed, e). The number of batches 
+    only depends on the lengths, so resume(n_batches) works as in ResumableSampler.
+    '''
+    def __init__(self, lengths, max_tokens, max_length, min_length=32, multiple=8, 
+            shuffle=True, seed=0, num_replicas=1, rank=0):
+        self.full_lengths = np.asarray(lengths, dtype=np.int64)
+        self.lengths = np.minimum(self.full_lengths, max_length) // multiple * multiple
+        self.inds = np.where(self.lengths >= max(min_length, multiple))[0]
+        if max_tokens < self.lengths.max():
+            raise ValueError(f'max_tokens={max_tokens} is smaller than max_length={self.lengths.max()}')
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.num_batches = ceil(len(self.batches(0)) / num_replicas)
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.start = 0
+
+    def resume(self, n_batches):
+        self.epoch = n_batches // self.num_batches
+        self.start = n_batches % self.num_batches
+
+    def batches(self, epoch):
+        # lists of (utterance index, offset, length), sorted by length with ties in random order
+        rng = np.random.default_rng([self.seed, epoch])
+        lengths = self.lengths[self.inds]
+        if self.shuffle:
+            offsets = (rng.random(len(self.inds)) * (self.full_lengths[self.inds] - lengths + 1)).astype(np.int64)
+            order = np.lexsort((rng.random(len(self.inds)), lengths))
+        else:
+            offsets = np.zeros(len(self.inds), dtype=np.int64)
+            order = np.argsort(lengths, kind='stable')
+        batches, batch = [], []
+        for i in order:
+            # ascending lengths, the new utterance is the longest of the batch
+            if len(batch) > 0 and (len(batch) + 1) * lengths[i] > self.max_tokens:
+                batches.append(batch)
+                batch = []
+            batch.append((int(self.inds[i]), int(offsets[i]), int(lengths[i])))
+        if len(batch) > 0:
+            batches.append(batch)
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def __iter__(self):
+        batches = self.batches(self.epoch)
+        # repeat the first batches to split evenly
+        total_size = self.num_batches * self.num_replicas
+        batches = (batches * ceil(total_size / len(batches)))[:total_size]
+        batches = batches[self.rank:total_size:self.num_replicas]
+        return iter(batches[self.start:])
+
+    def __len__(self):
+        return self.num_batches - self.start
+
 class SequenceDataset(Dataset):
     def __init__(self, data):
         self.data = data
@@ -56,3 +199,152 @@ class PickleDataset(Dataset):
     def __len__(self):
         return len(self.indexes)
 
+class FeatureStore(object):
+    '''Utterances concatenated in one [n_frames, n_mels] float32 .npy file and an offset/length index.
+    The file is opened with mmap lazily, so each DataLoader worker maps it by itself 
+    and shares the page cache instead of holding a private copy.
+    '''
+    def __init__(self, store_prefix):
+        self.data_path = f'{store_prefix}.npy'
+        with open(f'{store_prefix}.index.json', 'r') as f:
+            index = json.load(f)
+        self.utt_ids = index['utt_ids']
+        self.offsets = np.array(index['offsets'], dtype=np.int64)
+        self.lengths = np.array(index['lengths'], dtype=np.int64)
+        self.data = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['data'] = None
+        return state
+
+    def segment(self, ind, t, segment_size):
+        if self.data is None:
+            self.data = np.load(self.data_path, mmap_mode='r')
+        start = self.offsets[ind] + t
+        return self.data[start:start + segment_size]
+
+    def __len__(self):
+        return len(self.utt_ids)
+
+class SharedFeatures(object):
+    '''The FeatureStore interface over a pickled {utt_id: [length, n_mels]} dict, packed into one 
+    [n_frames, n_mels] tensor in shared memory and an offset/length table when it is built.
+    DataLoader workers attach to the same memory (inherited with fork, passed as a handle with spawn),
+    while the arrays of a dict are copied page by page into every worker as their refcounts change.
+    '''
+    def __init__(self, pickle_path):
+        with open(pickle_path, 'rb') as f:
+            data = pickle.load(f)
+        self.utt_ids = sorted(data.keys())
+        self.lengths = np.array([len(data[utt_id]) for utt_id in self.utt_ids], dtype=np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(self.lengths)[:-1]]).astype(np.int64)
+        n_mels = data[self.utt_ids[0]].shape[1]
+        self.data = torch.empty(int(self.lengths.sum()), n_mels, dtype=torch.float32).share_memory_()
+        for utt_id, offset, length in zip(self.utt_ids, self.offsets, self.lengths):
+            # free the dict while packing, so the features are not held twice
+            self.data[offset:offset + length] = torch.from_numpy(np.asarray(data.pop(utt_id), dtype=np.float32))
+
+    def segment(self, ind, t, segment_size):
+        start = self.offsets[ind] + t
+        return self.data[start:start + segment_size].numpy()
+
+    def __len__(self):
+        return len(self.utt_ids)
+
+class SegmentDataset(Dataset):
+    def __init__(self, features, sample_index_path, segment_size):
+        self.features = features
+        with open(sample_index_path, 'r') as f:
+            indexes = json.load(f)
+        utt2ind = {utt_id: ind for ind, utt_id in enumerate(features.utt_ids)}
+        # numpy arrays instead of a list of lists, so workers do not touch python objects
+        self.utt_inds = np.array([utt2ind[utt_id] for utt_id, _ in indexes], dtype=np.int64)
+        self.timesteps = np.array([t for _, t in indexes], dtype=np.int64)
+        self.segment_size = segment_size
+
+    def __getitem__(self, ind):
+        segment = self.features.segment(self.utt_inds[ind], self.timesteps[ind], self.segment_size)
+        return segment
+
+    def __len__(self):
+        return len(self.utt_inds)
+
+class PickleFeatures(object):
+    # the FeatureStore interface over a pickled {utt_id: [length, n_mels]} dict
+    def __init__(self, pickle_path):
+        with open(pickle_path, 'rb') as f:
+            data = pickle.load(f)
+        self.utt_ids = sorted(data.keys())
+        self.data = [data[utt_id] for utt_id in self.utt_ids]
+        self.lengths = np.array([len(val) for val in self.data], dtype=np.int64)
+
+    def segment(self, ind, t, segment_size):
+        return self.data[ind][t:t + segment_size]
+
+    def __len__(self):
+        return len(self.utt_ids)
+
+class UtteranceDataset(Dataset):
+    # items are the (utterance index, offset, length) of BucketBatchSampler
+    def __init__(self, features):
+        self.features = features
+
+    def __getitem__(self, item):
+        ind, t, length = item
+        return self.features.segment(ind, t, length)
+
+    def __len__(self):
+        return len(self.features)
+
+class RandomSegmentDataset(IterableDataset):
+    '''Draws (utterance, offset) pairs on the fly and yields whole batches.
+    weighting: 'uniform' picks every utterance equally often (as sample_single_segments.py),
+    'length' picks every segment equally often and 'speaker' picks every speaker equally often
+    (the speaker id is the part of the utterance id before the first '_').
+    Batch g is drawn with a generator seeded by (seed, rank, g) and worker w of n yields 
+    batches w, w + n, ..., the order in which DataLoader collects them. The stream therefore 
+    does not depend on num_workers and can be restarted at any batch with start_batch.
+    '''
+    def __init__(self, features, segment_size, batch_size, weighting='uniform', seed=0, rank=0):
+        self.features = features
+        self.segment_size = segment_size
+        self.batch_size = batch_size
+        self.seed = seed
+        self.rank = rank
+        self.start_batch = 0
+        self.utt_inds = np.where(features.lengths > segment_size)[0]
+        self.n_offsets = features.lengths[self.utt_inds] - segment_size + 1
+        if weighting == 'uniform':
+            probs = np.ones(len(self.utt_inds))
+        elif weighting == 'length':
+            probs = self.n_offsets.astype(np.float64)
+        elif weighting == 'speaker':
+            speakers = np.array([features.utt_ids[ind].split('_')[0] for ind in self.utt_inds])
+            _, speaker_inds, counts = np.unique(speakers, return_inverse=True, return_counts=True)
+            probs = 1. / counts[speaker_inds]
+        else:
+            raise ValueError(f'unknown weighting {weighting}')
+        self.probs = probs / probs.sum()
+
+    def resume(self, n_batches):
+        # batches are a function of their index, continue with batch n_batches
+        self.start_batch = n_batches
+
+    def sample(self, batch_index):
+        rng = np.random.default_rng([self.seed, self.rank, batch_index])
+        inds = rng.choice(len(self.utt_inds), size=self.batch_size, p=self.probs)
+        timesteps = (rng.random(self.batch_size) * self.n_offsets[inds]).astype(np.int64)
+        return inds, timesteps
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, n_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        batch_index = self.start_batch + worker_id
+        while True:
+            inds, timesteps = self.sample(batch_index)
+            batch = np.stack([self.features.segment(self.utt_inds[ind], t, self.segment_size) 
+                for ind, t in zip(inds, timesteps)])
+            yield batch
+            batch_index += n_workers
+
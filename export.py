@@ -0,0 +1,104 @@
+import torch
+import torch.nn as nn
+import yaml
+from argparse import ArgumentParser
+from model import AE
+from runtime import ExportedAE
+
+class SpeakerEncoderGraph(nn.Module):
+    def __init__(self, model):
+        super(SpeakerEncoderGraph, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model.get_speaker_embeddings(x)
+
+class ConverterGraph(nn.Module):
+    def __init__(self, model):
+        super(ConverterGraph, self).__init__()
+        self.model = model
+
+    def forward(self, x, emb, lengths):
+        return self.model.inference_from_embedding(x, emb, lengths)
+
+def example_inputs(config, batch_size=1, length=128):
+    x = torch.randn(batch_size, config['SpeakerEncoder']['c_in'], length)
+    emb = torch.randn(batch_size, config['SpeakerEncoder']['c_out'])
+    return x, emb
+
+def export_torchscript(model, config, output_path):
+    x, emb = example_inputs(config)
+    with torch.no_grad():
+        traced = torch.jit.trace_module(model, {'get_speaker_embeddings': (x,), 
+            'inference_from_embedding': (x, emb)})
+    traced = torch.jit.freeze(traced, preserved_attrs=['get_speaker_embeddings', 'inference_from_embedding'])
+    torch.jit.save(traced, output_path)
+    return
+
+def export_onnx(model, config, output_prefix, opset):
+    x, emb = example_inputs(config)
+    # the torch.export based exporter keeps the time axis symbolic through the pixel shuffle,
+    # the tracing one loses the channel size of the instance norm after it
+    batch = torch.export.Dim('batch', min=1)
+    length = torch.export.Dim('length', min=16)
+    torch.onnx.export(SpeakerEncoderGraph(model), (x,), f'{output_prefix}.speaker.onnx', 
+            input_names=['x'], output_names=['emb'], opset_version=opset, dynamo=True, 
+            dynamic_shapes={'x': {0: batch, 2: length}})
+    # the rounded up lengths of the subsampling do not survive as a symbolic time axis,
+    # so the converter takes x zero padded to a multiple of the total subsampling and the
+    # lengths before padding (see ExportedAE.inference_from_embedding)
+    lengths = torch.full((x.size(0),), x.size(2), dtype=torch.long)
+    n_blocks = torch.export.Dim('n_blocks', min=2)
+    torch.onnx.export(ConverterGraph(model), (x, emb, lengths), f'{output_prefix}.convert.onnx', 
+            input_names=['x', 'emb', 'lengths'], output_names=['dec'], opset_version=opset, dynamo=True, 
+            dynamic_shapes={'x': {0: batch, 2: model.total_subsample * n_blocks}, 'emb': {0: batch}, 
+                'lengths': {0: batch}})
+    return
+
+def check_parity(model, exported, config, lengths, tolerance):
+    # eager vs exported, the lengths differ from the traced one to check the dynamic time axis
+    passed = True
+    for length in lengths:
+        x, _ = example_inputs(config, batch_size=2, length=length)
+        x_cond, _ = example_inputs(config, batch_size=2, length=length // 2 + 8)
+        with torch.no_grad():
+            emb = model.get_speaker_embeddings(x_cond)
+            dec = model.inference_from_embedding(x, emb)
+            exported_emb = exported.get_speaker_embeddings(x_cond)
+            exported_dec = exported.inference_from_embedding(x, exported_emb)
+        diff = max((emb - exported_emb).abs().max().item(), (dec - exported_dec).abs().max().item())
+        print(f'{exported.path} length={length}: max abs diff={diff:.2e}')
+        passed = passed and dec.shape == exported_dec.shape and diff <= tolerance
+    return passed
+
+if __name__ == '__main__':
+    # python3 export.py -c config.yaml -m model.ckpt -o model -formats torchscript onnx --check
+    parser = ArgumentParser()
+    parser.add_argument('-config', '-c', help='config file path')
+    parser.add_argument('-model', '-m', help='model path')
+    parser.add_argument('-output', '-o', help='output prefix, writes <o>.pt / <o>.speaker.onnx + <o>.convert.onnx')
+    parser.add_argument('-formats', nargs='+', default=['torchscript', 'onnx'])
+    parser.add_argument('-opset', default=18, type=int)
+    parser.add_argument('--check', action='store_true', help='compare the exported graphs with the eager model')
+    parser.add_argument('-check_lengths', nargs='+', default=[64, 140, 201, 1000], type=int)
+    parser.add_argument('-tolerance', default=1e-4, type=float)
+    args = parser.parse_args()
+    with open(args.config) as f:
+        config = yaml.safe_load(f)
+    model = AE(config)
+    model.load_state_dict(torch.load(args.model, map_location='cpu'))
+    model.eval()
+    exported_paths = []
+    if 'torchscript' in args.formats:
+        export_torchscript(model, config, f'{args.output}.pt')
+        exported_paths.append(f'{args.output}.pt')
+    if 'onnx' in args.formats:
+        export_onnx(model, config, args.output, args.opset)
+        exported_paths.append(f'{args.output}.onnx')
+    print(f'Exported {exported_paths}')
+    if args.check:
+        passed = all([check_parity(model, ExportedAE(path, total_subsample=model.total_subsample), config, args.check_lengths, args.tolerance) 
+            for path in exported_paths])
+        print('parity check passed' if passed else 'parity check FAILED')
+        if not passed:
+            exit(1)
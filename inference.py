@@ -7,19 +7,33 @@ import torch.nn.functional as F
 import yaml
 import pickle
 from model import AE
+from model import get_receptive_field
 from utils import *
 from functools import reduce
+from math import ceil
 import json
 from collections import defaultdict
 from torch.utils.data import Dataset
 from torch.utils.data import TensorDataset
 from torch.utils.data import DataLoader
 from argparse import ArgumentParser, Namespace
-from scipy.io.wavfile import write
 import random
-from preprocess.tacotron.utils import melspectrogram2wav
-from preprocess.tacotron.utils import get_spectrograms
-import librosa 
+import time
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from preprocess.tacotron.griffin_lim import GriffinLim
+from speaker_cache import SpeakerCache
+from runtime import ExportedAE
+from preprocess.tacotron.frontend import get_frontend
+from preprocess.tacotron.audio import write_wav
+from preprocess.tacotron.audio import open_wav
+from preprocess.tacotron.audio import deemphasis
+from preprocess.tacotron.hyperparams import Hyperparams as hp
+
+def extract_mel(wav_path):
+    mel = get_frontend().get_spectrograms([wav_path])[0]
+    return mel
 
 class Inferencer(object):
     def __init__(self, config, args):
@@ -30,6 +44,12 @@ class Inferencer(object):
         self.args = args
         print(self.args)
 
+        # the int8 model only runs on CPU
+        if self.args.quantize or not torch.cuda.is_available():
+            self.device = torch.device('cpu')
+        else:
+            self.device = torch.device('cuda')
+
         # init the model with config
         self.build_model()
 
@@ -39,18 +59,48 @@ class Inferencer(object):
         with open(self.args.attr, 'rb') as f:
             self.attr = pickle.load(f)
 
+        if self.args.speaker_cache_dir:
+            model_path = self.model.speaker_path if self.args.exported else self.args.model
+            self.speaker_cache = SpeakerCache(self.args.speaker_cache_dir, model_path, 
+                    self.args.attr, capacity=self.args.speaker_cache_size, variant=self.args.quantize)
+        else:
+            self.speaker_cache = None
+
+        # the vocoder caches the mel inverse and the window
+        self.vocoder = GriffinLim(n_iter=self.args.n_iter, momentum=self.args.momentum)
+
     def load_model(self):
+        if self.args.exported:
+            # the exported graph holds the weights
+            return
         print(f'Load model from {self.args.model}')
-        self.model.load_state_dict(torch.load(f'{self.args.model}'))
+        self.model.load_state_dict(torch.load(f'{self.args.model}', map_location='cpu'))
+        if self.args.quantize:
+            # int8 copy for CPU inference, torch.ao is only imported when it is used
+            from quantize import quantize_model
+            from quantize import calibration_batches
+            print(f'Quantize model ({self.args.quantize})')
+            batches = calibration_batches(self.args.calibration_data, 
+                    segment_size=self.config['data_loader']['segment_size']) \
+                    if self.args.quantize == 'static' else None
+            self.model = quantize_model(self.model, self.args.quantize, batches)
         return
 
     def build_model(self): 
         # create model, discriminator, optimizers
-        self.model = cc(AE(self.config))
+        if self.args.exported:
+            print(f'Load exported model from {self.args.exported}')
+            self.model = self.cc(ExportedAE(self.args.exported, total_subsample=reduce(lambda x, y: x*y, 
+                self.config['ContentEncoder']['subsample'])))
+            return
+        self.model = self.cc(AE(self.config))
         print(self.model)
         self.model.eval()
         return
 
+    def cc(self, x):
+        return x.to(self.device)
+
     def utt_make_frames(self, x):
         frame_size = self.config['data_loader']['frame_size']
         remains = x.size(0) % frame_size 
@@ -59,16 +109,183 @@ class Inferencer(object):
         out = x.view(1, x.size(0) // frame_size, frame_size * x.size(1)).transpose(1, 2)
         return out
 
-    def inference_one_utterance(self, x, x_cond):
-        x = self.utt_make_frames(x)
+    def get_speaker_embedding(self, x_cond):
         x_cond = self.utt_make_frames(x_cond)
-        dec = self.model.inference(x, x_cond)
+        emb = self.model.get_speaker_embeddings(x_cond)
+        return emb
+
+    def compute_speaker_embedding(self, target_path):
+        tar_mel = extract_mel(target_path)
+        tar_mel = self.cc(torch.from_numpy(self.normalize(tar_mel)))
+        with torch.no_grad():
+            emb = self.get_speaker_embedding(tar_mel)
+        return emb.squeeze(0).cpu().numpy()
+
+    def speaker_embedding_from_path(self, target_path):
+        if self.speaker_cache is None:
+            emb = self.compute_speaker_embedding(target_path)
+        else:
+            emb = self.speaker_cache.get_or_compute(target_path, self.compute_speaker_embedding)
+        return self.cc(torch.from_numpy(emb)).unsqueeze(0)
+
+    def speaker_embedding_from_name(self, name):
+        if self.speaker_cache is None:
+            raise ValueError(f'speaker {name} can only be looked up with -speaker_cache_dir')
+        emb = self.speaker_cache.get_speaker(name, self.compute_speaker_embedding)
+        return self.cc(torch.from_numpy(emb)).unsqueeze(0)
+
+    def convert_mel(self, x, emb, chunked=False):
+        x = self.utt_make_frames(x)
+        if chunked:
+            dec = torch.cat(list(self.inference_chunks(x, emb)), dim=1)[:, :x.size(2)].unsqueeze(0)
+        else:
+            dec = self.model.inference_from_embedding(x, emb)
         dec = dec.transpose(1, 2).squeeze(0)
         dec = dec.detach().cpu().numpy()
         dec = self.denormalize(dec)
-        wav_data = melspectrogram2wav(dec)
+        return dec
+
+    def convert(self, x, emb, chunked=False):
+        dec = self.convert_mel(x, emb, chunked=chunked)
+        wav_data = self.vocoder.melspectrogram2wav(dec)
         return wav_data, dec
 
+    def convert_mel_batch(self, mels, embs):
+        '''mels: a list of normalized [length, c_in] tensors, embs: [batch_size, c_cond].
+        The batch is padded to the longest utterance and the model masks the padding with the lengths, 
+        so every output is the same as converting the utterance alone. 
+        The exported graphs take no lengths, they only batch utterances of the same length.
+        '''
+        if self.args.exported:
+            decs = [None] * len(mels)
+            groups = defaultdict(list)
+            for i, mel in enumerate(mels):
+                groups[mel.size(0)].append(i)
+            for inds in groups.values():
+                x = torch.cat([self.utt_make_frames(mels[i]) for i in inds], dim=0)
+                dec = self.model.inference_from_embedding(x, embs[inds])
+                dec = dec.transpose(1, 2).detach().cpu().numpy()
+                for i, d in zip(inds, dec):
+                    decs[i] = self.denormalize(d)
+            return decs
+        total_subsample = reduce(lambda x, y: x*y, self.config['ContentEncoder']['subsample'])
+        xs = [self.utt_make_frames(mel) for mel in mels]
+        lengths = [x.size(2) for x in xs]
+        max_length = int(ceil(max(lengths) / total_subsample)) * total_subsample
+        x = torch.cat([F.pad(x, (0, max_length - x.size(2))) for x in xs], dim=0)
+        dec = self.model.inference_from_embedding(x, embs, self.cc(torch.tensor(lengths)))
+        dec = dec.transpose(1, 2).detach().cpu().numpy()
+        decs = [self.denormalize(d[:int(ceil(length / total_subsample)) * total_subsample]) 
+                for d, length in zip(dec, lengths)]
+        return decs
+
+    def vocode_and_write(self, decs, output_paths):
+        wavs = self.vocoder(decs)
+        for wav_data, output_path in zip(wavs, output_paths):
+            self.write_wav_to_file(wav_data, output_path)
+        return sum(len(wav_data) for wav_data in wavs)
+
+    def inference_one_utterance(self, x, x_cond):
+        return self.convert(x, self.get_speaker_embedding(x_cond))
+
+    def inference_chunks(self, x, emb):
+        '''Converts x ([1, c_in, length]) window by window and yields the output chunk by chunk.
+        Each window holds chunk_size + chunk_overlap frames plus half of the receptive field
+        of ContentEncoder + Decoder on both sides (shifted inwards at the utterance edges). 
+        Neighbouring outputs are crossfaded over chunk_overlap frames, so chunk i is final 
+        as soon as window i + 1 is decoded.
+        '''
+        total_subsample = reduce(lambda x, y: x*y, self.config['ContentEncoder']['subsample'])
+        round_up = lambda n: int(ceil(n / total_subsample)) * total_subsample
+        hop = round_up(self.args.chunk_size)
+        overlap = round_up(self.args.chunk_overlap) if self.args.chunk_overlap > 0 else 0
+        context = round_up(get_receptive_field(self.config['ContentEncoder'], self.config['Decoder']) / 2)
+        window_size = hop + overlap + 2 * context
+        length = x.size(2)
+        if round_up(length) <= window_size:
+            yield self.model.inference_from_embedding(x, emb)[0]
+            return
+        # pad to the subsampling grid so that every window starts on it
+        x = F.pad(x, (0, round_up(length) - length), mode='replicate')
+        length = x.size(2)
+        fade_in = (torch.arange(overlap, device=x.device, dtype=x.dtype) + 0.5) / max(overlap, 1)
+        fade_out = 1 - fade_in
+        core_starts = list(range(0, length, hop))
+        tail = None
+        for i in range(0, len(core_starts), self.args.chunk_batch_size):
+            batch_core_starts = core_starts[i:i + self.args.chunk_batch_size]
+            starts = [min(max(core_start - context, 0), length - window_size) for core_start in batch_core_starts]
+            windows = torch.stack([x[0, :, start:start + window_size] for start in starts])
+            dec = self.model.inference_from_embedding(windows, emb.expand(len(starts), -1))
+            for out, start, core_start in zip(dec, starts, batch_core_starts):
+                out = out[:, core_start - start:core_start - start + hop + overlap]
+                if tail is not None:
+                    n = min(overlap, out.size(1))
+                    out[:, :n] = out[:, :n] * fade_in[:n] + tail[:, :n]
+                tail = out[:, hop:] * fade_out[:max(out.size(1) - hop, 0)]
+                yield out[:, :hop]
+
+    def vocode_chunks(self, chunks, length):
+        '''Vocodes the normalized output chunks of inference_chunks one by one and yields the waveform
+        piece by piece, so the first samples are ready after two chunks instead of the whole utterance.
+        Each chunk is vocoded with -chunk_gl_context frames of its neighbours on both sides and 
+        crossfaded with the previous one over one hop. Unlike convert, the silence at the ends is not trimmed.
+        length: the number of frames of the source, the padding of the last chunk is dropped.
+        '''
+        hop_length = self.vocoder.hop_length
+        fade_in = np.linspace(0, 1, hop_length + 2, dtype=np.float32)[1:-1]
+        context = max(self.args.chunk_gl_context, 1)
+        left, tail, last_output = None, None, 0.
+        mel, n_frames = None, 0
+        for chunk in itertools.chain(chunks, [None]):
+            next_mel = None
+            if chunk is not None and n_frames < length:
+                next_mel = self.denormalize(chunk[:, :length - n_frames].t().cpu().numpy())
+                n_frames += len(next_mel)
+            elif chunk is not None:
+                continue
+            if mel is not None:
+                right = next_mel[:context] if next_mel is not None else mel[:0]
+                left_frames = left if left is not None else mel[:0]
+                frames = np.concatenate([left_frames, mel, right]).astype(np.float32)
+                with torch.no_grad():
+                    mag = self.vocoder.mel_to_magnitude(torch.from_numpy(frames).unsqueeze(0))
+                    wav = self.vocoder.griffin_lim(mag)[0].numpy()
+                # wav[i] is sample i counted from the first frame of left_frames
+                begin = len(left_frames) * hop_length
+                body = wav[begin:begin + len(mel) * hop_length]
+                if tail is not None:
+                    head = wav[begin - hop_length:begin]
+                    body = np.concatenate([tail * fade_in[::-1] + head * fade_in, body])
+                if next_mel is not None:
+                    body, tail = body[:len(body) - hop_length], body[len(body) - hop_length:]
+                # de-emphasis continued from the last output sample
+                out = deemphasis(body.astype(np.float64), hp.preemphasis, initial=last_output)
+                last_output = out[-1] if len(out) > 0 else last_output
+                yield out.astype(np.float32)
+                left = mel[len(mel) - context:]
+            mel = next_mel
+
+    def convert_to_file_chunked(self, x, emb, output_path):
+        # writes every vocoded piece as soon as it is ready
+        x = self.utt_make_frames(x)
+        with open_wav(output_path, self.args.sample_rate) as f:
+            for wav_data in self.vocode_chunks(self.inference_chunks(x, emb), x.size(2)):
+                f.write(wav_data)
+
+    def inference_one_utterance_chunked(self, x, x_cond):
+        return self.convert(x, self.get_speaker_embedding(x_cond), chunked=True)
+
+    def check_chunked(self, x, emb):
+        # the windows only differ from the one-shot pass in their instance norm statistics
+        dec = self.convert_mel(x, emb)
+        chunked_dec = self.convert_mel(x, emb, chunked=True)
+        length = min(dec.shape[0], chunked_dec.shape[0])
+        diff = np.abs(self.normalize(dec[:length]) - self.normalize(chunked_dec[:length]))
+        print(f'chunked vs one-shot: mean abs diff={diff.mean():.4f}, max abs diff={diff.max():.4f} '
+                f'(normalized mel, tolerance={self.args.chunk_tolerance})')
+        return diff.mean() <= self.args.chunk_tolerance
+
     def denormalize(self, x):
         m, s = self.attr['mean'], self.attr['std']
         ret = x * s + m
@@ -80,30 +297,131 @@ class Inferencer(object):
         return ret
 
     def write_wav_to_file(self, wav_data, output_path):
-        write(output_path, rate=self.args.sample_rate, data=wav_data)
+        write_wav(output_path, wav_data, self.args.sample_rate)
+        return
+
+    def inference_from_manifest(self):
+        '''Converts every (source, target, output) row of a tab separated manifest.
+        Feature extraction runs in a process pool one bucket window ahead, the model runs on 
+        batches of similar length and Griffin-Lim + writing run in a thread pool.
+        A target that is not a file is looked up as a registered speaker name.
+        '''
+        with open(self.args.manifest, 'r') as f:
+            rows = [line.rstrip('\n').split('\t') for line in f if line.strip()]
+        start_time = time.time()
+        extract_pool = ProcessPoolExecutor(max_workers=self.args.n_workers)
+        write_pool = ThreadPoolExecutor(max_workers=self.args.n_workers)
+        window = self.args.bucket_window
+        blocks = [rows[i:i + window] for i in range(0, len(rows), window)]
+        extract = lambda block: extract_pool.map(extract_mel, [row[0] for row in block], chunksize=8)
+        embs = {}
+        writes = []
+        next_mels = extract(blocks[0]) if blocks else None
+        for block_ind, block in enumerate(blocks):
+            mels = list(next_mels)
+            if block_ind + 1 < len(blocks):
+                next_mels = extract(blocks[block_ind + 1])
+            for source, target, _ in block:
+                if target not in embs:
+                    if not os.path.exists(target) and self.speaker_cache is not None:
+                        embs[target] = self.speaker_embedding_from_name(target)
+                    else:
+                        embs[target] = self.speaker_embedding_from_path(target)
+            # length buckets
+            order = sorted(range(len(block)), key=lambda i: mels[i].shape[0])
+            for i in range(0, len(order), self.args.batch_size):
+                inds = order[i:i + self.args.batch_size]
+                src_mels = [self.cc(torch.from_numpy(self.normalize(mels[j]))) for j in inds]
+                emb = torch.cat([embs[block[j][1]] for j in inds], dim=0)
+                with torch.no_grad():
+                    decs = self.convert_mel_batch(src_mels, emb)
+                writes.append(write_pool.submit(self.vocode_and_write, decs, [block[j][2] for j in inds]))
+        n_samples = sum(w.result() for w in writes)
+        extract_pool.shutdown()
+        write_pool.shutdown()
+        elapsed = time.time() - start_time
+        audio_seconds = n_samples / self.args.sample_rate
+        print(f'{len(rows)} utterances in {elapsed:.2f}s, {len(rows) / elapsed:.2f} utt/s, '
+                f'real-time factor={elapsed / max(audio_seconds, 1e-8):.3f}')
+        return
+
+    def register_speaker(self):
+        if self.speaker_cache is None:
+            raise ValueError('-register requires -speaker_cache_dir')
+        self.speaker_cache.register(self.args.register, self.args.target, self.compute_speaker_embedding)
+        print(f'Registered speaker {self.args.register} from {self.args.target}')
         return
 
     def inference_from_path(self):
-        src_mel, _ = get_spectrograms(self.args.source)
-        tar_mel, _ = get_spectrograms(self.args.target)
-        src_mel = torch.from_numpy(self.normalize(src_mel)).cuda()
-        tar_mel = torch.from_numpy(self.normalize(tar_mel)).cuda()
-        conv_wav, conv_mel = self.inference_one_utterance(src_mel, tar_mel)
+        src_mel = extract_mel(self.args.source)
+        src_mel = self.cc(torch.from_numpy(self.normalize(src_mel)))
+        if self.args.speaker:
+            emb = self.speaker_embedding_from_name(self.args.speaker)
+        else:
+            emb = self.speaker_embedding_from_path(self.args.target)
+        with torch.no_grad():
+            if self.args.check_chunked:
+                self.check_chunked(src_mel, emb)
+            if self.args.chunk_size > 0:
+                self.convert_to_file_chunked(src_mel, emb, self.args.output)
+                return
+            conv_wav, conv_mel = self.convert(src_mel, emb)
         self.write_wav_to_file(conv_wav, self.args.output)
         return
 
-if __name__ == '__main__':
+def get_parser():
     parser = ArgumentParser()
     parser.add_argument('-attr', '-a', help='attr file path')
     parser.add_argument('-config', '-c', help='config file path')
     parser.add_argument('-model', '-m', help='model path')
+    parser.add_argument('-exported', help='model.pt or model.onnx written by export.py, used instead of -model', 
+            default='')
+    parser.add_argument('-quantize', help='run an int8 copy of the model on CPU', default='', 
+            choices=['', 'dynamic', 'static'])
+    parser.add_argument('-calibration_data', help='training feature pickle for -quantize static', default='')
     parser.add_argument('-source', '-s', help='source wav path')
     parser.add_argument('-target', '-t', help='target wav path')
     parser.add_argument('-output', '-o', help='output wav path')
     parser.add_argument('-sample_rate', '-sr', help='sample rate', default=24000, type=int)
+    parser.add_argument('-n_iter', help='griffin-lim iterations', default=100, type=int)
+    parser.add_argument('-momentum', help='fast griffin-lim momentum, 0 for the original griffin-lim', 
+            default=0., type=float)
+    parser.add_argument('-chunk_size', help='convert in chunks of n frames, 0 to convert in one pass', 
+            default=0, type=int)
+    parser.add_argument('-chunk_overlap', help='crossfade length between chunks', default=32, type=int)
+    parser.add_argument('-chunk_batch_size', help='number of chunks in one forward pass', default=8, type=int)
+    parser.add_argument('-chunk_gl_context', help='frames of the neighbouring chunks vocoded with a chunk', 
+            default=8, type=int)
+    parser.add_argument('-chunk_tolerance', help='allowed mean abs diff between chunked and one-shot', 
+            default=0.1, type=float)
+    parser.add_argument('--check_chunked', action='store_true')
+    parser.add_argument('-speaker_cache_dir', help='directory of cached speaker embeddings', default='')
+    parser.add_argument('-speaker_cache_size', help='number of embeddings kept in memory', default=128, type=int)
+    parser.add_argument('-speaker', help='registered speaker name, used instead of -target', default='')
+    parser.add_argument('-manifest', help='tab separated (source, target, output) rows for batch conversion', 
+            default='')
+    parser.add_argument('-batch_size', help='batch size of batch conversion', default=16, type=int)
+    parser.add_argument('-bucket_window', help='number of rows sorted by length together', default=256, type=int)
+    parser.add_argument('-n_workers', help='number of feature extraction and writing workers', default=4, type=int)
+    parser.add_argument('-register', help='register -target as this speaker name and exit', default='')
+    return parser
+
+if __name__ == '__main__':
+    parser = get_parser()
     args = parser.parse_args()
+    if (args.speaker or args.register) and not args.speaker_cache_dir:
+        parser.error('-speaker/-register require -speaker_cache_dir')
+    if args.check_chunked and args.chunk_size <= 0:
+        parser.error('--check_chunked requires -chunk_size > 0')
+    if args.quantize == 'static' and not args.calibration_data:
+        parser.error('-quantize static requires -calibration_data')
     # load config file 
     with open(args.config) as f:
-        config = yaml.load(f)
+        config = yaml.safe_load(f)
     inferencer = Inferencer(config=config, args=args)
-    inferencer.inference_from_path()
+    if args.register:
+        inferencer.register_speaker()
+    elif args.manifest:
+        inferencer.inference_from_manifest()
+    else:
+        inferencer.inference_from_path()
@@ -1,8 +1,39 @@
 from argparse import ArgumentParser, Namespace
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
 from solver import Solver
 import yaml 
 import sys
+import os
+
+def run(local_rank, args, config):
+    # one training process, args.n_procs > 1 are started by mp.spawn, 
+    # WORLD_SIZE > 1 by a launcher such as torchrun (env:// also covers several nodes)
+    if args.n_procs > 1:
+        rank, world_size, local_world_size = local_rank, args.n_procs, args.n_procs
+    else:
+        rank = int(os.environ.get('RANK', 0))
+        world_size = int(os.environ.get('WORLD_SIZE', 1))
+        local_rank = int(os.environ.get('LOCAL_RANK', 0))
+        local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', 1))
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank)
+    else:
+        # share the cores instead of every process using all of them
+        torch.set_num_threads(max(1, os.cpu_count() // local_world_size))
+    if world_size > 1:
+        dist.init_process_group(args.dist_backend, init_method='env://', rank=rank, world_size=world_size)
+
+    solver = Solver(config=config, args=args)
+
+    if args.iters > 0:
+        solver.train(n_iterations=args.iters)
+
+    if solver.logger is not None:
+        solver.logger.close()
+    if world_size > 1:
+        dist.destroy_process_group()
 
 if __name__ == '__main__':
     parser = ArgumentParser()
@@ -13,21 +44,36 @@ if __name__ == '__main__':
     parser.add_argument('-train_index_file', default='train_samples_64.json')
     parser.add_argument('-logdir', default='log/')
     parser.add_argument('--load_model', action='store_true')
-    parser.add_argument('--load_opt', action='store_true')
     parser.add_argument('-store_model_path', default='/storage/model/adaptive_vc/model')
     parser.add_argument('-load_model_path', default='/storage/model/adaptive_vc/model')
     parser.add_argument('-summary_steps', default=100, type=int)
     parser.add_argument('-save_steps', default=5000, type=int)
     parser.add_argument('-tag', '-t', default='init')
     parser.add_argument('-iters', default=0, type=int)
+    parser.add_argument('-profile_start', default=-1, type=int, 
+            help='record a torch profiler trace from this iteration, -1 to disable')
+    parser.add_argument('-profile_steps', default=5, type=int)
+    parser.add_argument('-keep_checkpoints', default=3, type=int, 
+            help='number of <store_model_path>-<iteration> checkpoints kept, 0 to only keep the latest')
+    parser.add_argument('-micro_batch_size', default=0, type=int, 
+            help='accumulate the gradients of micro-batches of this size, 0 for the whole batch at once')
+    parser.add_argument('-memory_budget', default=0, type=float, 
+            help='GB per process, probe the largest micro-batch that fits instead of -micro_batch_size')
+    parser.add_argument('-n_procs', default=1, type=int, 
+            help='number of local data parallel training processes')
+    parser.add_argument('-dist_backend', default='nccl' if torch.cuda.is_available() else 'gloo')
+    parser.add_argument('-master_addr', default='127.0.0.1')
+    parser.add_argument('-master_port', default='29500')
 
     args = parser.parse_args()
     
     # load config file 
     with open(args.config) as f:
-        config = yaml.load(f)
-
-    solver = Solver(config=config, args=args)
+        config = yaml.safe_load(f)
 
-    if args.iters > 0:
-        solver.train(n_iterations=args.iters)
+    if args.n_procs > 1:
+        os.environ.setdefault('MASTER_ADDR', args.master_addr)
+        os.environ.setdefault('MASTER_PORT', args.master_port)
+        mp.spawn(run, args=(args, config), nprocs=args.n_procs)
+    else:
+        run(0, args, config)
@@ -6,6 +6,7 @@ import numpy as np
 from math import ceil
 from functools import reduce
 from torch.nn.utils import spectral_norm
+from torch.utils.checkpoint import checkpoint
 from utils import cc
 
 class DummyEncoder(object):
@@ -18,16 +19,58 @@ class DummyEncoder(object):
     def __call__(self, x):
         return self.encoder(x)
 
-def pad_layer(inp, layer, pad_type='reflect'):
+def sequence_mask(lengths, max_length):
+    # [batch_size, 1, max_length], True for the frames inside each sequence
+    return (torch.arange(max_length, device=lengths.device).unsqueeze(0) < lengths.unsqueeze(1)).unsqueeze(1)
+
+def downsample_lengths(lengths, scale_factor):
+    # lengths after a stride / avg_pool1d(ceil_mode=True) of scale_factor
+    return (lengths + scale_factor - 1) // scale_factor
+
+def avg_pool(x, kernel_size, lengths=None):
+    # avg_pool1d(ceil_mode=True), with lengths the last window of a sequence only averages its own frames
+    # as for an unpadded sequence
+    if lengths is None:
+        return F.avg_pool1d(x, kernel_size=kernel_size, ceil_mode=True)
+    mask = sequence_mask(lengths, x.size(2)).to(x.dtype)
+    out = F.avg_pool1d(x * mask, kernel_size=kernel_size, ceil_mode=True)
+    return out / F.avg_pool1d(mask, kernel_size=kernel_size, ceil_mode=True).clamp(min=1e-8)
+
+def reflect_pad(inp, pad, lengths):
+    # F.pad(mode='reflect') at the end of every sequence instead of the end of the padded batch,
+    # so the frames inside a sequence do not depend on the padding after it
+    pad_l, pad_r = pad
+    t = torch.arange(-pad_l, inp.size(2) + pad_r, device=inp.device).unsqueeze(0)
+    last = (lengths - 1).unsqueeze(1)
+    ind = torch.abs(t)
+    ind = torch.where(ind > last, 2 * last - ind, ind).clamp(0, inp.size(2) - 1)
+    return inp.gather(2, ind.unsqueeze(1).expand(-1, inp.size(1), -1))
+
+def instance_norm(x, norm_layer, mask=None):
+    # norm_layer (affine=False) with the statistics of the frames inside each sequence only
+    if mask is None:
+        return norm_layer(x)
+    dtype = x.dtype
+    x, mask = x.float(), mask.float()
+    n = mask.sum(dim=2, keepdim=True)
+    mean = (x * mask).sum(dim=2, keepdim=True) / n
+    var = (((x - mean) * mask) ** 2).sum(dim=2, keepdim=True) / n
+    out = (x - mean) / torch.sqrt(var + norm_layer.eps)
+    return out.to(dtype)
+
+def pad_layer(inp, layer, pad_type='reflect', lengths=None):
     kernel_size = layer.kernel_size[0]
     if kernel_size % 2 == 0:
         pad = (kernel_size//2, kernel_size//2 - 1)
     else:
         pad = (kernel_size//2, kernel_size//2)
     # padding
-    inp = F.pad(inp, 
-            pad=pad,
-            mode=pad_type)
+    if lengths is None:
+        inp = F.pad(inp, 
+                pad=pad,
+                mode=pad_type)
+    elif kernel_size > 1:
+        inp = reflect_pad(inp, pad, lengths)
     out = layer(inp)
     return out
 
@@ -82,14 +125,59 @@ def append_cond(x, cond):
     out = x * std.unsqueeze(dim=2) + mean.unsqueeze(dim=2)
     return out
 
-def conv_bank(x, module_list, act, pad_type='reflect'):
-    outs = []
-    for layer in module_list:
-        out = act(pad_layer(x, layer, pad_type))
-        outs.append(out)
-    out = torch.cat(outs + [x], dim=1)
+def conv_bank(x, module_list, act, pad_type='reflect', fused=None, lengths=None):
+    # the input is padded once for the largest kernel, each kernel reads the slice 
+    # that its own pad_layer would give. fused=True zero-embeds all kernels into one kernel 
+    # of the largest size and runs one convolution (fewer launches, but 64 instead of 36 taps 
+    # for sizes 1..8, so it only pays off on GPU). the parameters stay in module_list, 
+    # so checkpoints are unchanged.
+    if fused is None:
+        fused = x.is_cuda
+    kernel_sizes = [layer.kernel_size[0] for layer in module_list]
+    pad_l = max([k // 2 for k in kernel_sizes])
+    pad_r = max([k - 1 - k // 2 for k in kernel_sizes])
+    if lengths is None:
+        inp = F.pad(x, pad=(pad_l, pad_r), mode=pad_type)
+    else:
+        inp = reflect_pad(x, (pad_l, pad_r), lengths)
+    if fused:
+        fused_size = pad_l + pad_r + 1
+        weight = torch.cat([F.pad(layer.weight, (pad_l - k // 2, fused_size - k - pad_l + k // 2)) 
+            for layer, k in zip(module_list, kernel_sizes)], dim=0)
+        bias = torch.cat([layer.bias for layer in module_list], dim=0)
+        out = F.conv1d(inp, weight, bias)
+    else:
+        length = x.size(2)
+        outs = [layer(inp[:, :, pad_l - k // 2:pad_l - k // 2 + length + k - 1]) 
+                for layer, k in zip(module_list, kernel_sizes)]
+        out = torch.cat(outs, dim=1)
+    out = torch.cat([act(out), x], dim=1)
     return out
 
+def get_receptive_field(content_config, decoder_config):
+    # receptive field (in frames) of ContentEncoder + Decoder, instance norm is not counted
+    field, jump = content_config['bank_size'], 1
+    for _, sub in zip(range(content_config['n_conv_blocks']), content_config['subsample']):
+        field += 2 * (content_config['kernel_size'] - 1) * jump
+        jump *= sub
+    for _, up in zip(range(decoder_config['n_conv_blocks']), decoder_config['upsample']):
+        field += 2 * (decoder_config['kernel_size'] - 1) * jump
+        jump /= up
+    return int(ceil(field))
+
+def get_checkpoint_blocks(setting, n_blocks):
+    # the blocks to checkpoint: a list of block indices, or every n-th block (0, n, 2n, ...) for an int n,
+    # 0 for none
+    if isinstance(setting, (list, tuple)):
+        return set(setting)
+    return set(range(0, n_blocks, setting)) if setting > 0 else set()
+
+def run_block(module, checkpointed, fn, *args):
+    # checkpointed blocks keep only their inputs and recompute their activations in backward
+    if checkpointed and module.training and torch.is_grad_enabled():
+        return checkpoint(fn, *args, use_reentrant=False)
+    return fn(*args)
+
 def get_act(act):
     if act == 'relu':
         return nn.ReLU()
@@ -210,7 +298,7 @@ class SpeakerEncoder(nn.Module):
     def __init__(self, c_in, c_h, c_out, kernel_size,
             bank_size, bank_scale, c_bank, 
             n_conv_blocks, n_dense_blocks, 
-            subsample, act, dropout_rate):
+            subsample, act, dropout_rate, checkpoint_blocks=0, checkpoint_bank=False):
         super(SpeakerEncoder, self).__init__()
         self.c_in = c_in
         self.c_h = c_h
@@ -233,21 +321,36 @@ class SpeakerEncoder(nn.Module):
         self.second_dense_layers = nn.ModuleList([nn.Linear(c_h, c_h) for _ in range(n_dense_blocks)])
         self.output_layer = nn.Linear(c_h, c_out)
         self.dropout_layer = nn.Dropout(p=dropout_rate)
+        # activation checkpointing, only while training
+        self.checkpoint_blocks = get_checkpoint_blocks(checkpoint_blocks, n_conv_blocks)
+        self.checkpoint_bank = checkpoint_bank
+
+    def bank(self, x, lengths=None):
+        # conv bank and dimension reduction layer, the wide concatenation only lives in here
+        out = conv_bank(x, self.conv_bank, act=self.act, lengths=lengths)
+        out = pad_layer(out, self.in_conv_layer)
+        return out
+
+    def conv_block(self, out, l, lengths=None):
+        y = pad_layer(out, self.first_conv_layers[l], lengths=lengths)
+        y = self.act(y)
+        y = self.dropout_layer(y)
+        y = pad_layer(y, self.second_conv_layers[l], lengths=lengths)
+        y = self.act(y)
+        y = self.dropout_layer(y)
+        if self.subsample[l] > 1:
+            out = avg_pool(out, self.subsample[l], lengths)
+        out = y + out
+        return out
 
-    def conv_blocks(self, inp):
+    def conv_blocks(self, inp, lengths=None):
         out = inp
         # convolution blocks
         for l in range(self.n_conv_blocks):
-            y = pad_layer(out, self.first_conv_layers[l])
-            y = self.act(y)
-            y = self.dropout_layer(y)
-            y = pad_layer(y, self.second_conv_layers[l])
-            y = self.act(y)
-            y = self.dropout_layer(y)
-            if self.subsample[l] > 1:
-                out = F.avg_pool1d(out, kernel_size=self.subsample[l], ceil_mode=True)
-            out = y + out
-        return out
+            out = run_block(self, l in self.checkpoint_blocks, self.conv_block, out, l, lengths)
+            if self.subsample[l] > 1 and lengths is not None:
+                lengths = downsample_lengths(lengths, self.subsample[l])
+        return out, lengths
 
     def dense_blocks(self, inp):
         out = inp
@@ -262,15 +365,18 @@ class SpeakerEncoder(nn.Module):
             out = y + out
         return out
 
-    def forward(self, x):
-        out = conv_bank(x, self.conv_bank, act=self.act)
-        # dimension reduction layer
-        out = pad_layer(out, self.in_conv_layer)
+    def forward(self, x, lengths=None):
+        # conv bank + dimension reduction layer
+        out = run_block(self, self.checkpoint_bank, self.bank, x, lengths)
         out = self.act(out)
         # conv blocks
-        out = self.conv_blocks(out)
+        out, lengths = self.conv_blocks(out, lengths)
         # avg pooling
-        out = self.pooling_layer(out).squeeze(2)
+        if lengths is None:
+            out = self.pooling_layer(out).squeeze(2)
+        else:
+            mask = sequence_mask(lengths, out.size(2)).to(out.dtype)
+            out = (out * mask).sum(dim=2) / mask.sum(dim=2)
         # dense blocks
         out = self.dense_blocks(out)
         out = self.output_layer(out)
@@ -280,7 +386,7 @@ class ContentEncoder(nn.Module):
     def __init__(self, c_in, c_h, c_out, kernel_size,
             bank_size, bank_scale, c_bank, 
             n_conv_blocks, subsample, 
-            act, dropout_rate):
+            act, dropout_rate, checkpoint_blocks=0, checkpoint_bank=False):
         super(ContentEncoder, self).__init__()
         self.n_conv_blocks = n_conv_blocks
         self.subsample = subsample
@@ -297,27 +403,48 @@ class ContentEncoder(nn.Module):
         self.mean_layer = nn.Conv1d(c_h, c_out, kernel_size=1)
         self.std_layer = nn.Conv1d(c_h, c_out, kernel_size=1)
         self.dropout_layer = nn.Dropout(p=dropout_rate)
+        # activation checkpointing, only while training
+        self.checkpoint_blocks = get_checkpoint_blocks(checkpoint_blocks, n_conv_blocks)
+        self.checkpoint_bank = checkpoint_bank
 
-    def forward(self, x):
-        out = conv_bank(x, self.conv_bank, act=self.act)
-        # dimension reduction layer
+    def bank(self, x, lengths=None):
+        # conv bank and dimension reduction layer, the wide concatenation only lives in here
+        out = conv_bank(x, self.conv_bank, act=self.act, lengths=lengths)
         out = pad_layer(out, self.in_conv_layer)
-        out = self.norm_layer(out)
+        return out
+
+    def conv_block(self, out, l, lengths=None):
+        # lengths: of the input of the block
+        mask = sequence_mask(lengths, out.size(2)) if lengths is not None else None
+        y = pad_layer(out, self.first_conv_layers[l], lengths=lengths)
+        y = instance_norm(y, self.norm_layer, mask)
+        y = self.act(y)
+        y = self.dropout_layer(y)
+        y = pad_layer(y, self.second_conv_layers[l], lengths=lengths)
+        if self.subsample[l] > 1:
+            out = avg_pool(out, self.subsample[l], lengths)
+            if lengths is not None:
+                lengths = downsample_lengths(lengths, self.subsample[l])
+                mask = sequence_mask(lengths, y.size(2))
+        y = instance_norm(y, self.norm_layer, mask)
+        y = self.act(y)
+        y = self.dropout_layer(y)
+        out = y + out
+        return out
+
+    def forward(self, x, lengths=None):
+        # lengths: valid frames of every sequence in a padded batch, None if there is no padding
+        mask = sequence_mask(lengths, x.size(2)) if lengths is not None else None
+        # conv bank + dimension reduction layer
+        out = run_block(self, self.checkpoint_bank, self.bank, x, lengths)
+        out = instance_norm(out, self.norm_layer, mask)
         out = self.act(out)
         out = self.dropout_layer(out)
         # convolution blocks
         for l in range(self.n_conv_blocks):
-            y = pad_layer(out, self.first_conv_layers[l])
-            y = self.norm_layer(y)
-            y = self.act(y)
-            y = self.dropout_layer(y)
-            y = pad_layer(y, self.second_conv_layers[l])
-            y = self.norm_layer(y)
-            y = self.act(y)
-            y = self.dropout_layer(y)
-            if self.subsample[l] > 1:
-                out = F.avg_pool1d(out, kernel_size=self.subsample[l], ceil_mode=True)
-            out = y + out
+            out = run_block(self, l in self.checkpoint_blocks, self.conv_block, out, l, lengths)
+            if self.subsample[l] > 1 and lengths is not None:
+                lengths = downsample_lengths(lengths, self.subsample[l])
         mu = pad_layer(out, self.mean_layer)
         log_sigma = pad_layer(out, self.std_layer)
         return mu, log_sigma
@@ -326,7 +453,7 @@ class Decoder(nn.Module):
     def __init__(self, 
             c_in, c_cond, c_h, c_out, 
             kernel_size,
-            n_conv_blocks, upsample, act, sn, dropout_rate):
+            n_conv_blocks, upsample, act, sn, dropout_rate, checkpoint_blocks=0):
         super(Decoder, self).__init__()
         self.n_conv_blocks = n_conv_blocks
         self.upsample = upsample
@@ -343,45 +470,69 @@ class Decoder(nn.Module):
                 [f(nn.Linear(c_cond, c_h * 2)) for _ in range(n_conv_blocks*2)])
         self.out_conv_layer = f(nn.Conv1d(c_h, c_out, kernel_size=1))
         self.dropout_layer = nn.Dropout(p=dropout_rate)
+        # activation checkpointing, only while training
+        self.checkpoint_blocks = get_checkpoint_blocks(checkpoint_blocks, n_conv_blocks)
+
+    def conv_block(self, out, cond, l, lengths=None):
+        # lengths: of the input of the block
+        mask = sequence_mask(lengths, out.size(2)) if lengths is not None else None
+        y = pad_layer(out, self.first_conv_layers[l], lengths=lengths)
+        y = instance_norm(y, self.norm_layer, mask)
+        y = append_cond(y, self.conv_affine_layers[l*2](cond))
+        y = self.act(y)
+        y = self.dropout_layer(y)
+        y = pad_layer(y, self.second_conv_layers[l], lengths=lengths)
+        if self.upsample[l] > 1:
+            y = pixel_shuffle_1d(y, scale_factor=self.upsample[l])
+            if lengths is not None:
+                lengths = lengths * self.upsample[l]
+                mask = sequence_mask(lengths, y.size(2))
+        y = instance_norm(y, self.norm_layer, mask)
+        y = append_cond(y, self.conv_affine_layers[l*2+1](cond))
+        y = self.act(y)
+        y = self.dropout_layer(y)
+        if self.upsample[l] > 1:
+            out = y + upsample(out, scale_factor=self.upsample[l]) 
+        else:
+            out = y + out
+        return out
 
-    def forward(self, z, cond):
+    def forward(self, z, cond, lengths=None):
+        # lengths: valid frames of every sequence of z
+        mask = sequence_mask(lengths, z.size(2)) if lengths is not None else None
         out = pad_layer(z, self.in_conv_layer)
-        out = self.norm_layer(out)
+        out = instance_norm(out, self.norm_layer, mask)
         out = self.act(out)
         out = self.dropout_layer(out)
         # convolution blocks
         for l in range(self.n_conv_blocks):
-            y = pad_layer(out, self.first_conv_layers[l])
-            y = self.norm_layer(y)
-            y = append_cond(y, self.conv_affine_layers[l*2](cond))
-            y = self.act(y)
-            y = self.dropout_layer(y)
-            y = pad_layer(y, self.second_conv_layers[l])
-            if self.upsample[l] > 1:
-                y = pixel_shuffle_1d(y, scale_factor=self.upsample[l])
-            y = self.norm_layer(y)
-            y = append_cond(y, self.conv_affine_layers[l*2+1](cond))
-            y = self.act(y)
-            y = self.dropout_layer(y)
-            if self.upsample[l] > 1:
-                out = y + upsample(out, scale_factor=self.upsample[l]) 
-            else:
-                out = y + out
+            out = run_block(self, l in self.checkpoint_blocks, self.conv_block, out, cond, l, lengths)
+            if self.upsample[l] > 1 and lengths is not None:
+                lengths = lengths * self.upsample[l]
         out = pad_layer(out, self.out_conv_layer)
         return out
 
 class AE(nn.Module):
     def __init__(self, config):
         super(AE, self).__init__()
-        self.speaker_encoder = SpeakerEncoder(**config['SpeakerEncoder']) 
-        self.content_encoder = ContentEncoder(**config['ContentEncoder'])
-        self.decoder = Decoder(**config['Decoder'])
+        # activation checkpointing per module, see get_checkpoint_blocks
+        checkpointing = config.get('checkpointing', {})
+        checkpoint_bank = checkpointing.get('conv_bank', False)
+        self.speaker_encoder = SpeakerEncoder(**config['SpeakerEncoder'], 
+                checkpoint_blocks=checkpointing.get('SpeakerEncoder', 0), checkpoint_bank=checkpoint_bank) 
+        self.content_encoder = ContentEncoder(**config['ContentEncoder'], 
+                checkpoint_blocks=checkpointing.get('ContentEncoder', 0), checkpoint_bank=checkpoint_bank)
+        self.decoder = Decoder(**config['Decoder'], checkpoint_blocks=checkpointing.get('Decoder', 0))
+        self.total_subsample = reduce(lambda x, y: x*y, config['ContentEncoder']['subsample'])
 
-    def forward(self, x):
-        emb = self.speaker_encoder(x)
-        mu, log_sigma = self.content_encoder(x)
+    def forward(self, x, lengths=None):
+        # lengths: valid frames of every utterance of a padded batch, multiples of the total subsampling
+        emb = self.speaker_encoder(x, lengths)
+        mu, log_sigma = self.content_encoder(x, lengths)
         eps = log_sigma.new(*log_sigma.size()).normal_(0, 1)
-        dec = self.decoder(mu + torch.exp(log_sigma / 2) * eps, emb)
+        if lengths is not None:
+            lengths = downsample_lengths(lengths, self.total_subsample)
+        dec = self.decoder(mu + torch.exp(log_sigma / 2) * eps, emb, lengths)
         return mu, log_sigma, emb, dec
 
     def inference(self, x, x_cond):
@@ -390,6 +541,15 @@ class AE(nn.Module):
         dec = self.decoder(mu, emb)
         return dec
 
+    def inference_from_embedding(self, x, emb, lengths=None):
+        # lengths: valid frames of every utterance of a padded batch, the output of each utterance
+        # is then the same as converting it alone
+        mu, _ = self.content_encoder(x, lengths)
+        if lengths is not None:
+            lengths = downsample_lengths(lengths, self.total_subsample)
+        dec = self.decoder(mu, emb, lengths)
+        return dec
+
     def get_speaker_embeddings(self, x):
         emb = self.speaker_encoder(x)
         return emb
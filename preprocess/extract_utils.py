@@ -0,0 +1,129 @@
+import os
+import time
+import hashlib
+import numpy as np
+from functools import partial
+from multiprocessing import Pool
+from tacotron.frontend import get_frontend
+from tacotron.frontend import VERSION as FRONTEND_VERSION
+from tacotron.hyperparams import Hyperparams as hp
+
+class FeatureCache(object):
+    '''mel features stored as cache_dir/ab/abcd....npy, keyed by the sha1 of the wav content
+    and the feature extraction hyperparameters and front-end version, so a changed file, config or
+    front-end is a miss.
+    '''
+    hparams = ['sr', 'n_fft', 'hop_length', 'win_length', 'n_mels', 'preemphasis', 'top_db', 'max_db', 'ref_db']
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.hparams_key = repr([('frontend', FRONTEND_VERSION)] + 
+                [(name, getattr(hp, name)) for name in self.hparams]).encode()
+
+    def key(self, wav_file):
+        h = hashlib.sha1(self.hparams_key)
+        with open(wav_file, 'rb') as f:
+            h.update(f.read())
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f'{key}.npy')
+
+    def load(self, key):
+        path = self.path(key)
+        if os.path.exists(path):
+            return np.load(path)
+        return None
+
+    def save(self, key, mel):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # several workers may write the same key
+        tmp_path = f'{path}.{os.getpid()}.tmp.npy'
+        np.save(tmp_path, mel)
+        os.replace(tmp_path, path)
+
+class RunningStats(object):
+    '''Per-dimension mean and variance of [n_frames, dim] arrays, updated one array at a time.
+    Two stats merge with the parallel variance formula (Chan et al.), so they can be computed
+    in worker processes and combined without keeping the frames.
+    '''
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    @classmethod
+    def from_array(cls, x):
+        stats = cls()
+        stats.count = x.shape[0]
+        stats.mean = np.mean(x, axis=0, dtype=np.float64)
+        stats.m2 = np.sum((x - stats.mean) ** 2, axis=0)
+        return stats
+
+    def update(self, x):
+        return self.merge(RunningStats.from_array(x))
+
+    def merge(self, other):
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count, self.mean, self.m2 = other.count, other.mean.copy(), other.m2.copy()
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.count / count
+        self.m2 = self.m2 + other.m2 + delta ** 2 * self.count * other.count / count
+        self.count = count
+        return self
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / self.count)
+
+def extract_chunk(wav_files, cache_dir=None):
+    # returns [(mel, cache hit, stats of mel)], the misses go through the front-end as one batch
+    cache = FeatureCache(cache_dir) if cache_dir is not None else None
+    keys = [cache.key(wav_file) for wav_file in wav_files] if cache is not None else None
+    mels = [cache.load(key) for key in keys] if cache is not None else [None] * len(wav_files)
+    misses = [i for i, mel in enumerate(mels) if mel is None]
+    if len(misses) > 0:
+        batch_mels = get_frontend().get_spectrograms([wav_files[i] for i in misses])
+        for i, mel in zip(misses, batch_mels):
+            mels[i] = mel
+            if cache is not None:
+                cache.save(keys[i], mel)
+    return [(mel, i not in misses, RunningStats.from_array(mel)) for i, mel in enumerate(mels)]
+
+def extract_mels(paths, n_workers=1, chunk_size=16, cache_dir=None, report_steps=500):
+    '''Yields (path, mel, stats of mel) in the order of paths.
+    The files are extracted in chunks of chunk_size, each chunk as one batch of the front-end.
+    With n_workers > 1 the chunks are spread over a process pool, imap keeps the 
+    input order so the results are identical to the serial run.
+    With cache_dir only new or changed files are extracted.
+    '''
+    start_time = time.time()
+    extract_fn = partial(extract_chunk, cache_dir=cache_dir)
+    chunks = [paths[i:i + chunk_size] for i in range(0, len(paths), chunk_size)]
+    if n_workers > 1:
+        pool = Pool(processes=n_workers)
+        results = pool.imap(extract_fn, chunks)
+    else:
+        pool = None
+        results = map(extract_fn, chunks)
+    results = (result for chunk_results in results for result in chunk_results)
+    n_hits = 0
+    try:
+        for i, (path, (mel, hit, stats)) in enumerate(zip(paths, results)):
+            n_hits += hit
+            if i % report_steps == 0 or i == len(paths) - 1:
+                elapsed = time.time() - start_time
+                print(f'processing {i + 1}/{len(paths)} files, '
+                        f'{(i + 1) / max(elapsed, 1e-8):.1f} files/s')
+            yield path, mel, stats
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    if cache_dir is not None:
+        print(f'feature cache: {n_hits} hits, {len(paths) - n_hits} misses')
@@ -9,6 +9,8 @@ import re
 import numpy as np
 import json
 from tacotron.utils import get_spectrograms
+from extract_utils import extract_mels
+from extract_utils import RunningStats
 
 def read_speaker_info(speaker_info_path):
     speaker_ids = []
@@ -43,6 +45,9 @@ if __name__ == '__main__':
     n_utts_attr = int(sys.argv[4])
     train_set = sys.argv[5]
     test_set = sys.argv[6]
+    n_workers = int(sys.argv[7]) if len(sys.argv) > 7 else 1
+    chunk_size = int(sys.argv[8]) if len(sys.argv) > 8 else 16
+    cache_dir = sys.argv[9] if len(sys.argv) > 9 else None
 
     paths = read_paths(data_dir, train_set)
     random.shuffle(paths)
@@ -72,24 +77,26 @@ if __name__ == '__main__':
         print(f'processing {dset} set, {len(paths)} files')
         data = {}
         output_path = os.path.join(output_dir, f'{dset}.pkl')
-        all_train_data = []
-        for i, path in enumerate(paths):
-            if i % 500 == 0 or i == len(paths) - 1:
-                print(f'processing {i} files')
+        attr_stats = RunningStats()
+        for i, (path, mel, stats) in enumerate(extract_mels(paths, n_workers, chunk_size, cache_dir)):
             filename = path.strip().split('/')[-1]
-            mel, mag = spec_feature_extraction(path)
+            if dset == 'train':
+                if i < n_utts_attr:
+                    attr_stats.merge(stats)
+            else:
+                # mean and std are known, normalize while streaming
+                mel -= mean
+                mel /= std
             data[filename] = mel
-            if dset == 'train' and i < n_utts_attr:
-                all_train_data.append(mel)
         if dset == 'train':
-            all_train_data = np.concatenate(all_train_data)
-            mean = np.mean(all_train_data, axis=0)
-            std = np.std(all_train_data, axis=0)
+            mean = attr_stats.mean.astype(np.float32)
+            std = attr_stats.std.astype(np.float32)
             attr = {'mean': mean, 'std': std}
             with open(os.path.join(output_dir, 'attr.pkl'), 'wb') as f:
                 pickle.dump(attr, f)
-        for key, val in data.items():
-            val = (val - mean) / std
-            data[key] = val
+            # in place, without a second copy of the data
+            for val in data.values():
+                val -= mean
+                val /= std
         with open(output_path, 'wb') as f:
             pickle.dump(data, f)
@@ -0,0 +1,27 @@
+import pickle 
+import sys
+import json
+import numpy as np
+
+if __name__ == '__main__':
+    pkl_path = sys.argv[1]
+    store_prefix = sys.argv[2]
+
+    with open(pkl_path, 'rb') as f:
+        data = pickle.load(f)
+
+    utt_ids = sorted(data.keys())
+    lengths = [data[utt_id].shape[0] for utt_id in utt_ids]
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).tolist()
+    n_mels = data[utt_ids[0]].shape[1]
+
+    store = np.lib.format.open_memmap(f'{store_prefix}.npy', mode='w+', 
+            dtype=np.float32, shape=(sum(lengths), n_mels))
+    for utt_id, offset, length in zip(utt_ids, offsets, lengths):
+        store[offset:offset + length] = data[utt_id]
+    store.flush()
+    del store
+
+    with open(f'{store_prefix}.index.json', 'w') as f:
+        json.dump({'utt_ids': utt_ids, 'offsets': offsets, 'lengths': lengths}, f)
+    print(f'{len(utt_ids)} utterances, {sum(lengths)} frames')
@@ -1,7 +1,7 @@
 . libri.config
 
 if [ $stage -le 0 ]; then
-    python3 make_datasets_libri.py $raw_data_dir/ $data_dir $test_prop $n_utts_attr $train_set $test_set
+    python3 make_datasets_libri.py $raw_data_dir/ $data_dir $test_prop $n_utts_attr $train_set $test_set $n_workers $chunk_size $cache_dir
 fi
 
 if [ $stage -le 1 ]; then
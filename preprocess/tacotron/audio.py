@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+'''
+Loading, trimming and writing waveforms with soundfile and numpy only.
+They give the same result as librosa.load / librosa.effects.trim / scipy.signal.lfilter,
+without importing scipy.signal and compiling the numba kernels of librosa on the first call.
+'''
+import numpy as np
+import soundfile as sf
+from functools import lru_cache
+
+def load_wav(fpath, sr):
+    y, file_sr = sf.read(fpath, dtype='float32', always_2d=True)
+    # to mono as librosa.to_mono
+    y = np.mean(y, axis=1) if y.shape[1] > 1 else y[:, 0]
+    if file_sr != sr:
+        import librosa
+        y = librosa.resample(y, orig_sr=file_sr, target_sr=sr)
+    return y
+
+def write_wav(fpath, y, sr):
+    # float wav as scipy.io.wavfile.write of a float32 array
+    sf.write(fpath, np.asarray(y, dtype=np.float32), sr, subtype='FLOAT')
+
+def open_wav(fpath, sr):
+    # a wav written piece by piece with .write(y), in the format of write_wav
+    return sf.SoundFile(fpath, 'w', samplerate=sr, channels=1, subtype='FLOAT')
+
+def trim(y, top_db=60, frame_length=2048, hop_length=512):
+    # librosa.effects.trim with ref=np.max: frame rms (centered, zero padded) in decibel
+    # relative to the loudest frame, cut before the first and after the last frame above -top_db
+    pad = frame_length // 2
+    frames = np.lib.stride_tricks.sliding_window_view(
+            np.pad(y, (pad, pad), mode='constant'), frame_length)[::hop_length]
+    rms = np.sqrt(np.mean(np.square(frames, dtype=np.float32), axis=-1))
+    db = 10 * np.log10(np.maximum(1e-10, np.square(rms))) - 10 * np.log10(np.maximum(1e-10, np.max(rms) ** 2))
+    nonzero = np.flatnonzero(db > -top_db)
+    if nonzero.size == 0:
+        return y[:0]
+    start = nonzero[0] * hop_length
+    end = min(len(y), (nonzero[-1] + 1) * hop_length)
+    return y[start:end]
+
+def hz_to_mel(hz):
+    # slaney mel scale: linear below 1 kHz, logarithmic above
+    hz = np.asanyarray(hz, dtype=np.float64)
+    f_sp, min_log_hz, logstep = 200.0 / 3, 1000.0, np.log(6.4) / 27.0
+    min_log_mel = min_log_hz / f_sp
+    return np.where(hz >= min_log_hz, min_log_mel + np.log(np.maximum(hz, min_log_hz) / min_log_hz) / logstep, hz / f_sp)
+
+def mel_to_hz(mels):
+    f_sp, min_log_hz, logstep = 200.0 / 3, 1000.0, np.log(6.4) / 27.0
+    min_log_mel = min_log_hz / f_sp
+    return np.where(mels >= min_log_mel, min_log_hz * np.exp(logstep * (mels - min_log_mel)), f_sp * mels)
+
+def mel_filters(sr, n_fft, n_mels, fmin=0.0, fmax=None):
+    # librosa.filters.mel with the default slaney scale and norm
+    fmax = sr / 2 if fmax is None else fmax
+    fftfreqs = np.fft.rfftfreq(n=n_fft, d=1.0 / sr)
+    mel_f = mel_to_hz(np.linspace(hz_to_mel(fmin), hz_to_mel(fmax), n_mels + 2))
+    fdiff = np.diff(mel_f)
+    ramps = np.subtract.outer(mel_f, fftfreqs)
+    lower = -ramps[:n_mels] / fdiff[:n_mels, np.newaxis]
+    upper = ramps[2:] / fdiff[1:, np.newaxis]
+    weights = np.maximum(0, np.minimum(lower, upper)).astype(np.float32)
+    weights *= (2.0 / (mel_f[2:n_mels + 2] - mel_f[:n_mels]))[:, np.newaxis]
+    return weights
+
+@lru_cache(maxsize=None)
+def mel_to_linear_matrix(sr, n_fft, n_mels):
+    # pseudo-inverse of the mel filterbank, m.T @ np.diag(1 / d) without building the dense diagonal
+    m = mel_filters(sr, n_fft, n_mels)
+    d = np.sum(np.matmul(m, m.T), axis=0)
+    d = np.where(np.abs(d) > 1.0e-8, 1.0 / np.where(d == 0, 1.0, d), d)
+    return m.T * d[np.newaxis, :]
+
+def preemphasis(y, coef):
+    return np.append(y[0], y[1:] - coef * y[:-1])
+
+def deemphasis(y, coef, initial=0., block_size=256):
+    # scipy.signal.lfilter([1], [1, -coef], y): y[n] = x[n] + coef * y[n - 1].
+    # inside a block it is a matrix product with the impulse response, the last output
+    # of every block is carried to the next one. initial is y[-1], to continue a stream
+    n = len(y)
+    n_blocks = (n + block_size - 1) // block_size
+    x = np.zeros(n_blocks * block_size, dtype=np.float64)
+    x[:n] = y
+    powers = coef ** np.arange(block_size + 1, dtype=np.float64)
+    response = np.tril(powers[np.subtract.outer(np.arange(block_size), np.arange(block_size)).clip(0)])
+    out = x.reshape(n_blocks, block_size) @ response.T
+    carry = initial
+    for b in range(n_blocks):
+        out[b] += carry * powers[1:]
+        carry = out[b, -1]
+    return out.reshape(-1)[:n]
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+'''
+Batched version of get_spectrograms, the mel basis and the window are built once.
+'''
+from .hyperparams import Hyperparams as hp
+import numpy as np
+import torch
+from .audio import load_wav
+from .audio import mel_filters
+from .audio import trim
+from .audio import preemphasis
+
+# bump whenever the extracted features change, it is part of the feature cache key.
+# 1: librosa get_spectrograms, 2: torch stft, 3: numpy filterbank, trim and resampling
+VERSION = 3
+
+class MelFrontend(object):
+    '''Computes the normalized log-mel of get_spectrograms for a batch of waveforms with one torch stft.
+    Every waveform is reflect padded by n_fft // 2 on its own (as librosa.stft with center=True),
+    then the batch is zero padded to the longest one and every output is cut back to its own frames,
+    so the padding does not change the result.
+    '''
+    def __init__(self, sr=hp.sr, n_fft=hp.n_fft, hop_length=hp.hop_length,
+            win_length=hp.win_length, n_mels=hp.n_mels):
+        self.sr = sr
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.win_length = win_length
+        self.mel_basis = torch.from_numpy(mel_filters(sr, n_fft, n_mels))
+        self.window = torch.hann_window(win_length)
+
+    def load(self, fpath):
+        # load, trim and preemphasis as in get_spectrograms
+        y = load_wav(fpath, self.sr)
+        y = trim(y, top_db=hp.top_db)
+        y = preemphasis(y, hp.preemphasis)
+        return y
+
+    def __call__(self, ys):
+        # ys: a list of 1d waveforms, returns a list of [length, n_mels] float32 arrays
+        pad = self.n_fft // 2
+        ys = [np.pad(y, pad, mode='reflect') for y in ys]
+        n_frames = [1 + (len(y) - self.n_fft) // self.hop_length for y in ys]
+        batch = np.zeros((len(ys), max([len(y) for y in ys])), dtype=np.float32)
+        for i, y in enumerate(ys):
+            batch[i, :len(y)] = y
+        with torch.no_grad():
+            mel = self.frames_to_mel(torch.from_numpy(batch)).numpy()
+        return [m[:n].astype(np.float32) for m, n in zip(mel, n_frames)]
+
+    def frames_to_mel(self, y):
+        # y: [batch_size, n_samples] already padded, returns [batch_size, n_frames, n_mels]
+        # for every frame that fits in y entirely (center=False)
+        linear = torch.stft(y, self.n_fft, hop_length=self.hop_length,
+                win_length=self.win_length, window=self.window, center=False, return_complex=True)
+        mel = torch.matmul(self.mel_basis, linear.abs())
+        # to decibel
+        mel = 20 * torch.log10(torch.clamp(mel, min=1e-5))
+        # normalize
+        mel = torch.clamp((mel - hp.ref_db + hp.max_db) / hp.max_db, 1e-8, 1)
+        return mel.transpose(1, 2)
+
+    def get_spectrograms(self, fpaths):
+        return self([self.load(fpath) for fpath in fpaths])
+
+_frontend = None
+
+def get_frontend():
+    # one front-end per process
+    global _frontend
+    if _frontend is None:
+        _frontend = MelFrontend()
+    return _frontend
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+'''
+Griffin-Lim reconstruction with torch, the mel pseudo-inverse and the window are built once.
+'''
+from .hyperparams import Hyperparams as hp
+import numpy as np
+import torch
+from .audio import deemphasis
+from .audio import mel_to_linear_matrix
+from .audio import trim
+
+class GriffinLim(object):
+    '''Converts normalized log-mel spectrograms to waveforms.
+    momentum=0 is the original Griffin-Lim, momentum > 0 is the fast Griffin-Lim
+    (Perraudin et al., 2013), which needs far fewer iterations (0.99 with ~30 iterations).
+    '''
+    def __init__(self, n_iter=hp.n_iter, momentum=0.,
+            sr=hp.sr, n_fft=hp.n_fft, hop_length=hp.hop_length,
+            win_length=hp.win_length, n_mels=hp.n_mels):
+        self.n_iter = n_iter
+        self.momentum = momentum
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.win_length = win_length
+        self.mel_inverse = torch.from_numpy(mel_to_linear_matrix(sr, n_fft, n_mels).astype(np.float32))
+        self.window = torch.hann_window(win_length)
+
+    def stft(self, y):
+        return torch.stft(y, self.n_fft, hop_length=self.hop_length, win_length=self.win_length,
+                window=self.window, center=True, pad_mode='reflect', return_complex=True)
+
+    def istft(self, spec, length):
+        return torch.istft(spec, self.n_fft, hop_length=self.hop_length, win_length=self.win_length,
+                window=self.window, center=True, length=length)
+
+    def mel_to_magnitude(self, mel):
+        # mel: [batch_size, length, n_mels], normalized as in get_spectrograms
+        mel = (torch.clamp(mel, 0, 1) * hp.max_db) - hp.max_db + hp.ref_db
+        mel = torch.pow(10.0, mel * 0.05)
+        mag = torch.matmul(mel, self.mel_inverse.t()).transpose(1, 2)
+        return mag
+
+    def griffin_lim(self, mag, n_iter=None, momentum=None):
+        # mag: [batch_size, 1 + n_fft // 2, length]
+        n_iter = self.n_iter if n_iter is None else n_iter
+        momentum = self.momentum if momentum is None else momentum
+        length = self.hop_length * (mag.size(2) - 1)
+        # the previous estimate is weighted by momentum / (1 + momentum) as in Perraudin et al.
+        # (and librosa, torchaudio)
+        alpha = momentum / (1 + momentum)
+        angles = torch.ones_like(mag, dtype=torch.complex64)
+        rebuilt = torch.zeros_like(angles)
+        for i in range(n_iter):
+            prev = rebuilt
+            rebuilt = self.stft(self.istft(mag * angles, length))
+            angles = rebuilt - prev * alpha if momentum > 0 else rebuilt
+            angles = angles / torch.clamp(angles.abs(), min=1e-8)
+        return self.istft(mag * angles, length)
+
+    def __call__(self, mels, n_iter=None, momentum=None):
+        '''mels: a list of [length, n_mels] arrays, returns a list of waveforms.
+        Spectrograms of the same length are reconstructed in one batch. Padding would change the 
+        last samples of the shorter ones, so every waveform is the same as reconstructing it alone.
+        '''
+        groups = {}
+        for i, mel in enumerate(mels):
+            groups.setdefault(mel.shape[0], []).append(i)
+        outputs = [None] * len(mels)
+        for length, inds in groups.items():
+            batch = np.stack([mels[i] for i in inds]).astype(np.float32)
+            with torch.no_grad():
+                mag = self.mel_to_magnitude(torch.from_numpy(batch))
+                wavs = self.griffin_lim(mag, n_iter=n_iter, momentum=momentum).numpy()
+            for i, wav in zip(inds, wavs):
+                wav = wav.astype(np.float64)
+                # de-preemphasis
+                wav = deemphasis(wav, hp.preemphasis)
+                # trim
+                wav = trim(wav)
+                outputs[i] = wav.astype(np.float32)
+        return outputs
+
+    def melspectrogram2wav(self, mel, n_iter=None, momentum=None):
+        return self([mel], n_iter=n_iter, momentum=momentum)[0]
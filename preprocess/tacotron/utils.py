@@ -8,21 +8,21 @@ from __future__ import print_function, division
 
 from .hyperparams import Hyperparams as hp
 import numpy as np
-import tensorflow as tf
 import librosa
 import copy
+from functools import lru_cache
 #import matplotlib
 #matplotlib.use('pdf')
 #import matplotlib.pyplot as plt
 from scipy import signal
 import os
 
-def _mel_to_linear_matrix(sr, n_fft, n_mels):
-    m = librosa.filters.mel(sr, n_fft, n_mels)
-    m_t = np.transpose(m)
-    p = np.matmul(m, m_t)
-    d = [1.0 / x if np.abs(x) > 1.0e-8 else x for x in np.sum(p, axis=0)]
-    return np.matmul(m_t, np.diag(d))
+# the filterbank of audio.py is the same as librosa.filters.mel
+from .audio import mel_to_linear_matrix as _mel_to_linear_matrix
+
+@lru_cache(maxsize=None)
+def _mel_basis(sr, n_fft, n_mels):
+    return librosa.filters.mel(sr, n_fft, n_mels)
 
 def get_spectrograms(fpath):
     '''Returns normalized log(melspectrogram) and log(magnitude) from `sound_file`.
@@ -69,7 +69,7 @@ def get_spectrograms(fpath):
     mag = np.abs(linear)  # (1+n_fft//2, T)
 
     # mel spectrogram
-    mel_basis = librosa.filters.mel(hp.sr, hp.n_fft, hp.n_mels)  # (n_mels, 1+n_fft//2)
+    mel_basis = _mel_basis(hp.sr, hp.n_fft, hp.n_mels)  # (n_mels, 1+n_fft//2)
     mel = np.dot(mel_basis, mag)  # (n_mels, t)
 
     # to decibel
@@ -170,6 +170,7 @@ def plot_alignment(alignment, gs):
 
 def learning_rate_decay(init_lr, global_step, warmup_steps=4000.):
     '''Noam scheme from tensor2tensor'''
+    import tensorflow as tf
     step = tf.cast(global_step + 1, dtype=tf.float32)
     return init_lr * warmup_steps ** 0.5 * tf.minimum(step * warmup_steps ** -1.5, step ** -0.5)
 
@@ -0,0 +1,149 @@
+import io
+import copy
+import time
+import torch
+import torch.nn as nn
+import numpy as np
+import yaml
+from argparse import ArgumentParser
+import torch.ao.quantization as tq
+from model import AE
+from data_utils import PickleFeatures
+from export import export_torchscript
+
+class QuantizedLayer(nn.Module):
+    '''Wraps a Conv1d / Linear so that only the layer runs in int8: the input is quantized with
+    the scale observed during calibration and the output is dequantized again. Padding,
+    instance norm and the residual additions stay in fp32. kernel_size is kept for pad_layer.
+    '''
+    def __init__(self, layer):
+        super(QuantizedLayer, self).__init__()
+        self.quant = tq.QuantStub()
+        self.layer = layer
+        self.dequant = tq.DeQuantStub()
+        self.kernel_size = getattr(layer, 'kernel_size', None)
+
+    def forward(self, x):
+        return self.dequant(self.layer(self.quant(x)))
+
+def wrap_layers(module, qconfig):
+    for name, child in module.named_children():
+        if isinstance(child, (nn.Conv1d, nn.Linear)):
+            wrapped = QuantizedLayer(child)
+            wrapped.qconfig = qconfig
+            setattr(module, name, wrapped)
+        else:
+            wrap_layers(child, qconfig)
+    return module
+
+def quantize_dynamic(model):
+    # int8 weights, activations quantized on the fly. only Linear, the dynamic Conv1d kernels
+    # lose too much precision (~50% relative error on a single layer)
+    return tq.quantize_dynamic(copy.deepcopy(model).cpu().eval(), {nn.Linear}, dtype=torch.qint8)
+
+def quantize_static(model, calibration_batches, backend='x86'):
+    # int8 weights (per channel) and activations for every Conv1d / Linear,
+    # the activation ranges are observed on calibration_batches
+    torch.backends.quantized.engine = backend
+    model = wrap_layers(copy.deepcopy(model).cpu().eval(), tq.get_default_qconfig(backend))
+    tq.prepare(model, inplace=True)
+    with torch.no_grad():
+        for x in calibration_batches:
+            model.inference(x, x)
+    tq.convert(model, inplace=True)
+    return model
+
+def quantize_model(model, mode, calibration_batches=None):
+    if mode == 'dynamic':
+        return quantize_dynamic(model)
+    elif mode == 'static':
+        if calibration_batches is None:
+            raise ValueError('static quantization needs calibration data')
+        return quantize_static(model, calibration_batches)
+    else:
+        raise ValueError(f'unknown quantization mode {mode}, dynamic or static')
+
+def sample_batches(features, indexes, n_batches, batch_size, segment_size, seed=0):
+    # random segments of the utterances in indexes that are at least segment_size long
+    rng = np.random.default_rng(seed)
+    indexes = [ind for ind in indexes if features.lengths[ind] >= segment_size]
+    batches = []
+    for _ in range(n_batches):
+        segments = []
+        for ind in rng.choice(indexes, size=batch_size):
+            t = rng.integers(0, features.lengths[ind] - segment_size + 1)
+            segments.append(np.asarray(features.segment(ind, t, segment_size)).T)
+        batches.append(torch.from_numpy(np.stack(segments).astype(np.float32)))
+    return batches
+
+def calibration_batches(pickle_path, n_batches=16, batch_size=16, segment_size=128, seed=0):
+    features = PickleFeatures(pickle_path)
+    return sample_batches(features, range(len(features)), n_batches, batch_size, segment_size, seed)
+
+def model_size(model):
+    buf = io.BytesIO()
+    torch.save(model.state_dict(), buf)
+    return len(buf.getvalue())
+
+def latency(model, batches, n_warmup=2):
+    with torch.no_grad():
+        for x in batches[:n_warmup]:
+            model.inference(x, x)
+        start_time = time.time()
+        for x in batches:
+            model.inference(x, x)
+    return (time.time() - start_time) / len(batches)
+
+def reconstruction_error(model, batches):
+    with torch.no_grad():
+        return np.mean([torch.mean(torch.abs(model.inference(x, x) - x)).item() for x in batches])
+
+if __name__ == '__main__':
+    # python3 quantize.py -c config.yaml -m model.ckpt -mode static -data train_128.pkl -o model.int8
+    parser = ArgumentParser()
+    parser.add_argument('-config', '-c', help='config file path')
+    parser.add_argument('-model', '-m', help='model path')
+    parser.add_argument('-mode', default='static', choices=['dynamic', 'static'])
+    parser.add_argument('-data', help='training feature pickle, sampled for calibration and evaluation')
+    parser.add_argument('-eval_data', help='held-out feature pickle, default: utterances of -data not used for calibration',
+            default='')
+    parser.add_argument('-n_calibration_utts', default=256, type=int)
+    parser.add_argument('-n_batches', default=16, type=int)
+    parser.add_argument('-batch_size', default=16, type=int)
+    parser.add_argument('-segment_size', default=128, type=int)
+    parser.add_argument('-n_threads', default=1, type=int)
+    parser.add_argument('-seed', default=0, type=int)
+    parser.add_argument('-output', '-o', help='writes the quantized model as TorchScript to <o>.pt', default='')
+    args = parser.parse_args()
+    torch.set_num_threads(args.n_threads)
+    with open(args.config) as f:
+        config = yaml.safe_load(f)
+    model = AE(config)
+    model.load_state_dict(torch.load(args.model, map_location='cpu'))
+    model.eval()
+
+    features = PickleFeatures(args.data)
+    perm = np.random.default_rng(args.seed).permutation(len(features))
+    calibration_indexes = perm[:args.n_calibration_utts]
+    calibration = sample_batches(features, calibration_indexes, args.n_batches,
+            args.batch_size, args.segment_size, args.seed)
+    if args.eval_data:
+        eval_features = PickleFeatures(args.eval_data)
+        eval_indexes = range(len(eval_features))
+    else:
+        eval_features, eval_indexes = features, perm[args.n_calibration_utts:]
+    held_out = sample_batches(eval_features, eval_indexes, args.n_batches,
+            args.batch_size, args.segment_size, args.seed + 1)
+
+    quantized = quantize_model(model, args.mode, calibration)
+    results = {}
+    for name, m in [('fp32', model), (f'int8 {args.mode}', quantized)]:
+        results[name] = (latency(m, held_out), model_size(m), reconstruction_error(m, held_out))
+    fp32_latency, fp32_size, fp32_error = results['fp32']
+    for name, (step_time, size, error) in results.items():
+        print(f'{name}: {step_time * 1000:.1f} ms/batch of {args.batch_size}x{args.segment_size} frames '
+                f'({fp32_latency / step_time:.2f}x), weights={size / 2 ** 20:.1f} MB, '
+                f'L1 reconstruction={error:.4f} ({error - fp32_error:+.4f})')
+    if args.output:
+        export_torchscript(quantized, config, f'{args.output}.pt')
+        print(f'Wrote {args.output}.pt, use it with inference.py -exported')
@@ -0,0 +1,59 @@
+import os
+import torch
+import torch.nn.functional as F
+import numpy as np
+
+class ExportedAE(object):
+    '''Runs an AE exported by export.py without model.py or the checkpoint.
+    path is either the TorchScript file (model.pt) or the ONNX prefix (model.onnx, 
+    which reads model.speaker.onnx and model.convert.onnx with ONNX Runtime).
+    Inputs and outputs are torch tensors, as with AE.
+    total_subsample: the product of the ContentEncoder subsampling of the exported model.
+    '''
+    def __init__(self, path, n_threads=0, total_subsample=8):
+        self.path = path
+        self.total_subsample = total_subsample
+        if path.endswith('.onnx'):
+            import onnxruntime as ort
+            options = ort.SessionOptions()
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            if n_threads > 0:
+                options.intra_op_num_threads = n_threads
+            prefix = path[:-len('.onnx')]
+            self.speaker_path = f'{prefix}.speaker.onnx'
+            self.speaker_session = ort.InferenceSession(self.speaker_path, options, 
+                    providers=['CPUExecutionProvider'])
+            self.convert_session = ort.InferenceSession(f'{prefix}.convert.onnx', options, 
+                    providers=['CPUExecutionProvider'])
+            self.module = None
+        else:
+            self.speaker_path = path
+            self.module = torch.jit.load(path, map_location='cpu')
+
+    def to(self, device):
+        if self.module is not None:
+            self.module = self.module.to(device)
+        return self
+
+    def eval(self):
+        return self
+
+    def get_speaker_embeddings(self, x):
+        if self.module is not None:
+            return self.module.get_speaker_embeddings(x)
+        emb, = self.speaker_session.run(None, {'x': x.detach().cpu().numpy()})
+        return torch.from_numpy(emb).to(x.device)
+
+    def inference_from_embedding(self, x, emb):
+        if self.module is not None:
+            return self.module.inference_from_embedding(x, emb)
+        # the graph takes multiples of the total subsampling, the model masks the padding with the lengths
+        lengths = torch.full((x.size(0),), x.size(2), dtype=torch.long)
+        x = F.pad(x, (0, -x.size(2) % self.total_subsample))
+        dec, = self.convert_session.run(None, {'x': x.detach().cpu().numpy(), 
+            'emb': emb.detach().cpu().numpy(), 'lengths': lengths.numpy()})
+        return torch.from_numpy(dec).to(x.device)
+
+    def inference(self, x, x_cond):
+        emb = self.get_speaker_embeddings(x_cond)
+        return self.inference_from_embedding(x, emb)
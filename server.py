@@ -0,0 +1,256 @@
+import os
+import json
+import time
+import asyncio
+import yaml
+import torch
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
+from inference import Inferencer
+from inference import get_parser
+from inference import extract_mel
+from preprocess.tacotron.griffin_lim import GriffinLim
+from preprocess.tacotron.audio import write_wav
+
+_vocoder = None
+
+def vocode_and_write(decs, output_paths, n_iter, momentum, sample_rate):
+    # runs in the vocoder processes, one GriffinLim per process. returns the duration or the 
+    # error of every output, so that one failed write does not fail the other requests
+    global _vocoder
+    if _vocoder is None:
+        torch.set_num_threads(1)
+        _vocoder = GriffinLim(n_iter=n_iter, momentum=momentum)
+    wavs = _vocoder(decs)
+    results = []
+    for wav_data, output_path in zip(wavs, output_paths):
+        try:
+            write_wav(output_path, wav_data, sample_rate)
+            results.append(len(wav_data) / sample_rate)
+        except Exception as e:
+            # the error types of soundfile do not all survive pickling
+            results.append(RuntimeError(str(e)))
+    return results
+
+class RequestError(Exception):
+    # a request that can not be served as it was sent, answered with 400
+    pass
+
+class Request(object):
+    def __init__(self, source, output, target=None, speaker=None):
+        self.source = source
+        self.output = output
+        self.target = target
+        self.speaker = speaker
+        self.arrival_time = time.time()
+        self.future = asyncio.get_running_loop().create_future()
+
+class Server(object):
+    '''Keeps the model warm and converts queued requests in micro-batches.
+    A batch is closed when it holds max_batch_size requests or its first request has waited
+    max_latency_ms. Feature extraction runs in a thread pool, the model in one thread
+    and Griffin-Lim + writing in a process pool. A request that fails (e.g. an unreadable source
+    or an unknown speaker) only fails itself, not the other requests of its batch.
+    POST /convert {"source": ..., "target": ... or "speaker": ..., "output": ...}
+    GET /metrics
+    '''
+    def __init__(self, inferencer, args):
+        self.inferencer = inferencer
+        self.args = args
+        self.queue = None
+        self.extract_pool = ThreadPoolExecutor(max_workers=args.n_workers)
+        self.model_pool = ThreadPoolExecutor(max_workers=1)
+        self.vocoder_pool = ProcessPoolExecutor(max_workers=args.n_workers)
+        self.latencies = deque(maxlen=1000)
+        self.batch_sizes = deque(maxlen=1000)
+        self.n_requests = 0
+        self.n_errors = 0
+        self.n_in_flight = 0
+        self.start_time = time.time()
+        # the running tasks, the event loop only keeps weak references to them
+        self.tasks = set()
+
+    def metrics(self):
+        latencies = np.array(self.latencies) * 1000 if len(self.latencies) > 0 else np.zeros(1)
+        return {'queue_depth': self.queue.qsize(),
+                'in_flight': self.n_in_flight,
+                'requests': self.n_requests,
+                'errors': self.n_errors,
+                'uptime_s': time.time() - self.start_time,
+                'latency_ms': {f'p{q}': float(np.percentile(latencies, q)) for q in (50, 90, 99)},
+                'mean_batch_size': float(np.mean(self.batch_sizes)) if len(self.batch_sizes) > 0 else 0.}
+
+    async def next_batch(self):
+        batch = [await self.queue.get()]
+        deadline = batch[0].arrival_time + self.args.max_latency_ms / 1000
+        while len(batch) < self.args.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def spawn(self, coroutine):
+        task = asyncio.ensure_future(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def extract(self, request):
+        if not os.path.isfile(request.source):
+            raise RequestError(f'source {request.source} not found')
+        return extract_mel(request.source)
+
+    def embedding(self, request):
+        if request.speaker:
+            if self.inferencer.speaker_cache is None:
+                raise RequestError('speaker requires the server to run with -speaker_cache_dir')
+            try:
+                return self.inferencer.speaker_embedding_from_name(request.speaker)
+            except KeyError as e:
+                raise RequestError(e.args[0])
+        if not os.path.isfile(request.target):
+            raise RequestError(f'target {request.target} not found')
+        return self.inferencer.speaker_embedding_from_path(request.target)
+
+    def forward(self, mels, embs):
+        src_mels = [self.inferencer.cc(torch.from_numpy(self.inferencer.normalize(mel))) for mel in mels]
+        emb = torch.cat(embs, dim=0)
+        with torch.no_grad():
+            return self.inferencer.convert_mel_batch(src_mels, emb)
+
+    async def run_batch(self, batch):
+        loop = asyncio.get_running_loop()
+        try:
+            # per request, so that one bad source / target / speaker only fails its own request
+            mels = await asyncio.gather(*[loop.run_in_executor(self.extract_pool, self.extract, request)
+                for request in batch], return_exceptions=True)
+            embs = await asyncio.gather(*[loop.run_in_executor(self.model_pool, self.embedding, request)
+                for request in batch], return_exceptions=True)
+            valid = []
+            for request, mel, emb in zip(batch, mels, embs):
+                if isinstance(mel, Exception) or isinstance(emb, Exception):
+                    request.future.set_exception(mel if isinstance(mel, Exception) else emb)
+                else:
+                    valid.append((request, mel, emb))
+            if len(valid) == 0:
+                return
+            requests, mels, embs = zip(*valid)
+            decs = await loop.run_in_executor(self.model_pool, self.forward, mels, embs)
+            durations = await loop.run_in_executor(self.vocoder_pool, vocode_and_write, decs,
+                    [request.output for request in requests], self.args.n_iter, self.args.momentum,
+                    self.args.sample_rate)
+            for request, duration in zip(requests, durations):
+                if isinstance(duration, Exception):
+                    request.future.set_exception(duration)
+                else:
+                    request.future.set_result({'output': request.output, 'duration_s': duration})
+        except Exception as e:
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_exception(e)
+        finally:
+            self.n_in_flight -= len(batch)
+
+    async def batcher(self):
+        while True:
+            batch = await self.next_batch()
+            self.batch_sizes.append(len(batch))
+            self.n_in_flight += len(batch)
+            # the next batch is collected while this one runs
+            self.spawn(self.run_batch(batch))
+
+    async def respond(self, writer, status, body):
+        body = json.dumps(body).encode()
+        writer.write(f'HTTP/1.1 {status}\r\nContent-Type: application/json\r\n'
+                f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+        await writer.drain()
+        writer.close()
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode().split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode().strip()
+                if not line:
+                    break
+                key, value = line.split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+            method, path = request_line[0], request_line[1]
+        except Exception:
+            await self.respond(writer, '400 Bad Request', {'error': 'malformed request'})
+            return
+        if method == 'GET' and path == '/metrics':
+            await self.respond(writer, '200 OK', self.metrics())
+        elif method == 'POST' and path == '/convert':
+            self.n_requests += 1
+            try:
+                params = json.loads(body)
+                request = Request(params['source'], params['output'],
+                        target=params.get('target'), speaker=params.get('speaker'))
+            except (ValueError, KeyError):
+                self.n_errors += 1
+                await self.respond(writer, '400 Bad Request', {'error': 'source and output are required'})
+                return
+            if not request.target and not request.speaker:
+                self.n_errors += 1
+                await self.respond(writer, '400 Bad Request', {'error': 'target or speaker is required'})
+                return
+            output_dir = os.path.dirname(os.path.abspath(request.output))
+            if not os.path.isdir(output_dir) or not os.access(output_dir, os.W_OK):
+                self.n_errors += 1
+                await self.respond(writer, '400 Bad Request', {'error': f'can not write to {output_dir}'})
+                return
+            await self.queue.put(request)
+            try:
+                result = await request.future
+            except RequestError as e:
+                self.n_errors += 1
+                await self.respond(writer, '400 Bad Request', {'error': str(e)})
+                return
+            except Exception as e:
+                self.n_errors += 1
+                await self.respond(writer, '500 Internal Server Error', {'error': str(e)})
+                return
+            latency = time.time() - request.arrival_time
+            self.latencies.append(latency)
+            result['latency_ms'] = latency * 1000
+            await self.respond(writer, '200 OK', result)
+        else:
+            await self.respond(writer, '404 Not Found', {'error': f'unknown path {path}'})
+
+    async def serve(self):
+        self.queue = asyncio.Queue()
+        self.spawn(self.batcher())
+        if self.args.unix_socket:
+            server = await asyncio.start_unix_server(self.handle, path=self.args.unix_socket)
+            print(f'Serving on {self.args.unix_socket}')
+        else:
+            server = await asyncio.start_server(self.handle, host=self.args.host, port=self.args.port)
+            print(f'Serving on http://{self.args.host}:{self.args.port}')
+        async with server:
+            await server.serve_forever()
+
+if __name__ == '__main__':
+    # python3 server.py -c config.yaml -m model.ckpt -a attr.pkl -port 8000
+    # curl -d '{"source": "s.wav", "target": "t.wav", "output": "o.wav"}' localhost:8000/convert
+    parser = get_parser()
+    parser.add_argument('-host', default='127.0.0.1')
+    parser.add_argument('-port', default=8000, type=int)
+    parser.add_argument('-unix_socket', default='', help='serve on this unix socket instead of tcp')
+    parser.add_argument('-max_batch_size', default=16, type=int)
+    parser.add_argument('-max_latency_ms', default=50, type=float,
+            help='how long the first request of a batch waits for more requests')
+    args = parser.parse_args()
+    with open(args.config) as f:
+        config = yaml.safe_load(f)
+    inferencer = Inferencer(config=config, args=args)
+    server = Server(inferencer, args)
+    asyncio.run(server.serve())
@@ -6,40 +6,164 @@ import torch.nn as nn
 import torch.nn.functional as F
 import yaml
 import pickle
+import time
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import IterableDataset
 from model import AE
+from model import sequence_mask
+from model import downsample_lengths
 from data_utils import get_data_loader
 from data_utils import PickleDataset
+from data_utils import FeatureStore
+from data_utils import SegmentDataset
+from data_utils import PickleFeatures
+from data_utils import SharedFeatures
+from data_utils import RandomSegmentDataset
+from data_utils import ResumableSampler
+from data_utils import UtteranceDataset
+from data_utils import BucketBatchSampler
+import random
 from utils import *
 from functools import reduce
 from collections import defaultdict
+from collections import deque
+from contextlib import nullcontext
+from math import ceil
+
+def masked_mean(x, lengths):
+    # mean of x [batch_size, channels, length] over the frames inside each sequence
+    mask = sequence_mask(lengths, x.size(2)).to(x.dtype)
+    return torch.sum(x * mask) / (torch.sum(mask) * x.size(1))
+
+def vae_losses(x, mu, log_sigma, dec, lengths=None, total_subsample=1):
+    # (reconstruction, kl) of the training step, also used by the benchmarks
+    # losses in fp32, exp(log_sigma) overflows in fp16
+    mu, log_sigma, dec = mu.float(), log_sigma.float(), dec.float()
+    kl = 0.5 * (torch.exp(log_sigma) + mu ** 2 - 1 - log_sigma)
+    if lengths is None:
+        criterion = nn.L1Loss()
+        loss_rec = criterion(dec, x)
+        loss_kl = torch.mean(kl)
+    else:
+        # the padding does not count
+        loss_rec = masked_mean(torch.abs(dec - x), lengths)
+        loss_kl = masked_mean(kl, downsample_lengths(lengths, total_subsample))
+    return loss_rec, loss_kl
 
 class Solver(object):
     def __init__(self, config, args):
+        # rank and number of processes of data parallel training, (0, 1) without torch.distributed
+        self.distributed = dist.is_available() and dist.is_initialized()
+        self.rank = dist.get_rank() if self.distributed else 0
+        self.world_size = dist.get_world_size() if self.distributed else 1
+        # only the first process logs and saves
+        self.is_main = self.rank == 0
+
         # config store the value of hyperparameters, turn to attr by AttrDict
         self.config = config
-        print(config)
+        if self.is_main:
+            print(config)
 
         # args store other information
         self.args = args
-        print(self.args)
+        if self.is_main:
+            print(self.args)
 
         # logger to use tensorboard
-        self.logger = Logger(self.args.logdir)
+        self.logger = Logger(self.args.logdir) if self.is_main else None
+
+        # wall-clock time of data wait / forward / backward / step / logging / checkpoint
+        self.timer = StageTimer(sync=torch.cuda.is_available())
+        self.profiler = None
+
+        # checkpoints are written in the background, training continues from start_iteration
+        self.checkpointer = AsyncCheckpointer(keep=self.args.keep_checkpoints)
+        self.start_iteration = 0
 
         # get dataloader
         self.get_data_loaders()
 
         # init the model with config
         self.build_model()
-        self.save_config()
+        if self.is_main:
+            self.save_config()
 
         if args.load_model:
             self.load_model()
 
+        # a batch is split into micro-batches whose gradients are accumulated, 0 for the whole batch
+        if self.args.memory_budget > 0:
+            self.micro_batch_size = self.probe_micro_batch_size(self.args.memory_budget * 2 ** 30)
+        else:
+            self.micro_batch_size = self.args.micro_batch_size
+
+        # averages the gradients over the processes, self.model stays the plain AE for saving
+        if self.distributed:
+            self.parallel_model = DistributedDataParallel(self.model)
+        else:
+            self.parallel_model = self.model
+
     def save_model(self, iteration):
-        # save model and discriminator and their optimizer
-        torch.save(self.model.state_dict(), f'{self.args.store_model_path}.ckpt')
-        torch.save(self.opt.state_dict(), f'{self.args.store_model_path}.opt')
+        # save model and discriminator and their optimizer, 
+        # every process takes part (rng states), the first one writes
+        state = self.training_state(iteration)
+        if self.is_main:
+            self.checkpointer.save(self.args.store_model_path, iteration + 1, 
+                    {'ckpt': self.model.state_dict(), 'opt': self.opt.state_dict(), 'state': state})
+
+    def rng_state(self):
+        state = {'torch': torch.get_rng_state(), 
+                'numpy': np.random.get_state(), 
+                'random': random.getstate()}
+        if torch.cuda.is_available():
+            state['cuda'] = torch.cuda.get_rng_state()
+        return state
+
+    def set_rng_state(self, state):
+        torch.set_rng_state(state['torch'])
+        np.random.set_state(state['numpy'])
+        random.setstate(state['random'])
+        if torch.cuda.is_available() and 'cuda' in state:
+            torch.cuda.set_rng_state(state['cuda'])
+
+    def training_state(self, iteration):
+        # the sampler position is the number of batches used, the workers have prefetched more
+        if self.distributed:
+            rng_states = [None] * self.world_size
+            dist.all_gather_object(rng_states, self.rng_state())
+        else:
+            rng_states = [self.rng_state()]
+        state = {'precision': self.precision, 
+                'scaler': self.scaler.state_dict(), 
+                'iteration': iteration + 1, 
+                'lambda_kl': self.lambda_kl(iteration), 
+                'n_batches': iteration + 1, 
+                'world_size': self.world_size, 
+                'rng': rng_states}
+        return state
+
+    def load_training_state(self, state):
+        if state['precision'] != self.precision:
+            if self.is_main:
+                print(f'Checkpoint was trained with {state["precision"]}, continue with {self.precision}')
+        elif state['scaler']:
+            self.scaler.load_state_dict(state['scaler'])
+        if 'iteration' not in state:
+            return
+        self.start_iteration = state['iteration']
+        if isinstance(self.train_dataset, RandomSegmentDataset):
+            self.train_dataset.resume(state['n_batches'])
+        elif isinstance(self.train_dataset, UtteranceDataset):
+            self.train_loader.batch_sampler.resume(state['n_batches'])
+        else:
+            self.train_loader.sampler.resume(state['n_batches'], self.config['data_loader']['batch_size'])
+        if state['world_size'] == self.world_size:
+            self.set_rng_state(state['rng'][self.rank])
+        elif self.is_main:
+            print(f'Checkpoint was trained with {state["world_size"]} processes, the rng states are not restored')
+        if self.is_main:
+            print(f'Resume from iteration {self.start_iteration}')
 
     def save_config(self):
         with open(f'{self.args.store_model_path}.config.yaml', 'w') as f:
@@ -49,71 +173,293 @@ class Solver(object):
         return
 
     def load_model(self):
-        print(f'Load model from {self.args.load_model_path}')
-        self.model.load_state_dict(torch.load(f'{self.args.load_model_path}.ckpt'))
-        self.opt.load_state_dict(torch.load(f'{self.args.load_model_path}.opt'))
+        if self.is_main:
+            print(f'Load model from {self.args.load_model_path}')
+        device = next(self.model.parameters()).device
+        path = self.args.load_model_path
+        if os.path.exists(f'{path}.latest'):
+            # the last complete checkpoint, <path>.ckpt/.opt/.state can be from two saves after a crash
+            with open(f'{path}.latest') as f:
+                path = f'{path}-{int(f.read())}'
+        self.model.load_state_dict(torch.load(f'{path}.ckpt', map_location=device))
+        self.opt.load_state_dict(torch.load(f'{path}.opt', map_location=device))
+        if os.path.exists(f'{path}.state'):
+            # the rng states hold numpy arrays
+            self.load_training_state(torch.load(f'{path}.state', map_location=device, weights_only=False))
         return
 
+    def load_features(self):
+        if self.config['data_loader']['dataset'] == 'feature_store':
+            return FeatureStore(os.path.join(self.args.data_dir, self.args.train_set))
+        elif self.config['data_loader']['dataset'] == 'shared':
+            return SharedFeatures(os.path.join(self.args.data_dir, f'{self.args.train_set}.pkl'))
+        else:
+            return PickleFeatures(os.path.join(self.args.data_dir, f'{self.args.train_set}.pkl'))
+
     def get_data_loaders(self):
         data_dir = self.args.data_dir
-        self.train_dataset = PickleDataset(os.path.join(data_dir, f'{self.args.train_set}.pkl'), 
-                os.path.join(data_dir, self.args.train_index_file), 
-                segment_size=self.config['data_loader']['segment_size'])
+        batch_sampler = None
+        if self.config['data_loader']['sampler'] == 'bucket':
+            # whole utterances in length buckets under a token budget
+            features = self.load_features()
+            self.train_dataset = UtteranceDataset(features)
+            multiple = reduce(lambda x, y: x*y, self.config['ContentEncoder']['subsample']) * \
+                    self.config['data_loader']['frame_size']
+            batch_sampler = BucketBatchSampler(features.lengths, 
+                    max_tokens=self.config['data_loader']['max_tokens'], 
+                    max_length=self.config['data_loader']['max_length'], 
+                    min_length=self.config['data_loader']['min_length'], 
+                    multiple=multiple, 
+                    shuffle=self.config['data_loader']['shuffle'], 
+                    seed=self.config['data_loader']['seed'], 
+                    num_replicas=self.world_size, rank=self.rank)
+        elif self.config['data_loader']['sampler'] == 'random':
+            features = self.load_features()
+            self.train_dataset = RandomSegmentDataset(features, 
+                    segment_size=self.config['data_loader']['segment_size'], 
+                    batch_size=self.config['data_loader']['batch_size'], 
+                    weighting=self.config['data_loader']['sample_weighting'], 
+                    seed=self.config['data_loader']['seed'], 
+                    rank=self.rank)
+        elif self.config['data_loader']['dataset'] in ['feature_store', 'shared']:
+            features = self.load_features()
+            self.train_dataset = SegmentDataset(features, 
+                    os.path.join(data_dir, self.args.train_index_file), 
+                    segment_size=self.config['data_loader']['segment_size'])
+        else:
+            self.train_dataset = PickleDataset(os.path.join(data_dir, f'{self.args.train_set}.pkl'), 
+                    os.path.join(data_dir, self.args.train_index_file), 
+                    segment_size=self.config['data_loader']['segment_size'])
+        # every process reads its own shard of the samples, the random sampler has the rank in its seed
+        if batch_sampler is None and not isinstance(self.train_dataset, IterableDataset):
+            sampler = ResumableSampler(self.train_dataset, shuffle=self.config['data_loader']['shuffle'], 
+                    seed=self.config['data_loader']['seed'], num_replicas=self.world_size, rank=self.rank)
+        else:
+            sampler = None
         self.train_loader = get_data_loader(self.train_dataset,
                 frame_size=self.config['data_loader']['frame_size'],
                 batch_size=self.config['data_loader']['batch_size'], 
                 shuffle=self.config['data_loader']['shuffle'], 
-                num_workers=4, drop_last=False)
+                num_workers=self.config['data_loader']['num_workers'], 
+                prefetch_factor=self.config['data_loader']['prefetch_factor'], 
+                persistent_workers=self.config['data_loader']['persistent_workers'], 
+                drop_last=False, sampler=sampler, batch_sampler=batch_sampler)
         self.train_iter = infinite_iter(self.train_loader)
         return
 
     def build_model(self): 
         # create model, discriminator, optimizers
         self.model = cc(AE(self.config))
-        print(self.model)
+        if self.is_main:
+            print(self.model)
         optimizer = self.config['optimizer']
         self.opt = torch.optim.Adam(self.model.parameters(), 
                 lr=optimizer['lr'], betas=(optimizer['beta1'], optimizer['beta2']), 
                 amsgrad=optimizer['amsgrad'], weight_decay=optimizer['weight_decay'])
-        print(self.opt)
+        if self.is_main:
+            print(self.opt)
+        self.build_precision()
         return
 
+    def build_precision(self):
+        # fp32 / bf16 (autocast, no loss scaling) / fp16 (autocast + GradScaler, cuda only)
+        self.device_type = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.precision = self.config.get('precision', 'fp32')
+        if self.precision == 'fp16' and self.device_type != 'cuda':
+            if self.is_main:
+                print('fp16 needs cuda for loss scaling, use bf16 instead')
+            self.precision = 'bf16'
+        self.autocast_dtype = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}[self.precision]
+        self.scaler = get_grad_scaler(enabled=self.precision == 'fp16')
+        return
+
+    def ae_loss(self, model, x, lengths):
+        with torch.autocast(device_type=self.device_type, dtype=self.autocast_dtype, 
+                enabled=self.precision != 'fp32'):
+            mu, log_sigma, emb, dec = model(x, lengths)
+        return vae_losses(x, mu, log_sigma, dec, lengths, self.model.total_subsample)
+
+    def micro_batches(self, x, lengths):
+        # [(x, lengths, weight)], weight is the share of a micro-batch in the mean losses of the batch 
+        # (segments, or valid frames for bucketed batches), so the accumulated gradient is the one of the batch
+        m = self.micro_batch_size
+        if m <= 0 or (lengths is None and m >= x.size(0)):
+            return [(x, lengths, 1.)]
+        if lengths is None:
+            return [(x[i:i + m], None, x[i:i + m].size(0) / x.size(0)) for i in range(0, x.size(0), m)]
+        # bucketed batches: at most m * max_length frames with padding, cut to the longest utterance
+        max_tokens = m * self.config['data_loader']['max_length']
+        order = torch.argsort(lengths).tolist()
+        chunks, chunk = [], []
+        for i in order:
+            if len(chunk) > 0 and (len(chunk) + 1) * lengths[i].item() > max_tokens:
+                chunks.append(chunk)
+                chunk = []
+            chunk.append(i)
+        chunks.append(chunk)
+        total = lengths.sum().item()
+        micro_batches = []
+        for chunk in chunks:
+            inds = torch.tensor(chunk, device=lengths.device)
+            micro_lengths = lengths[inds]
+            micro_x = x[inds][:, :, :micro_lengths.max().item()]
+            micro_batches.append((micro_x, micro_lengths, micro_lengths.sum().item() / total))
+        return micro_batches
+
+    def trial_step(self, batch_size, segment_size):
+        # peak memory in bytes and seconds of one forward/backward on random data, 
+        # including the optimizer state that the first step allocates
+        x = cc(torch.randn(batch_size, self.config['SpeakerEncoder']['c_in'], segment_size))
+        param_bytes = sum(p.numel() * p.element_size() for p in self.model.parameters())
+        opt_bytes = (3 if self.config['optimizer']['amsgrad'] else 2) * param_bytes
+        self.model.zero_grad(set_to_none=True)
+        start_time = time.time()
+        try:
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+                torch.cuda.reset_peak_memory_stats()
+                loss_rec, loss_kl = self.ae_loss(self.model, x, None)
+                self.scaler.scale(loss_rec + loss_kl).backward()
+                torch.cuda.synchronize()
+                peak = torch.cuda.max_memory_allocated()
+            else:
+                # parameters + gradients + activations saved for backward
+                with ActivationMemory() as memory:
+                    loss_rec, loss_kl = self.ae_loss(self.model, x, None)
+                self.scaler.scale(loss_rec + loss_kl).backward()
+                peak = memory.bytes + 2 * param_bytes
+        except torch.cuda.OutOfMemoryError:
+            peak = float('inf')
+        finally:
+            self.model.zero_grad(set_to_none=True)
+        return peak + opt_bytes, time.time() - start_time
+
+    def probe_micro_batch_size(self, budget):
+        # the largest micro-batch (at most one batch) whose trial step fits in budget bytes:
+        # doubling, then bisection between the last size that fits and the first one that does not
+        if self.config['data_loader']['sampler'] == 'bucket':
+            segment_size = self.config['data_loader']['max_length']
+            batch_size = self.config['data_loader']['max_tokens'] // segment_size
+        else:
+            segment_size = self.config['data_loader']['segment_size']
+            batch_size = self.config['data_loader']['batch_size']
+        def fits(m):
+            peak, seconds = self.trial_step(m, segment_size)
+            if self.is_main:
+                print(f'micro_batch_size={m}: peak memory={peak / 2 ** 20:.0f}MB, {m / seconds:.1f} seg/s')
+            return peak <= budget
+        # the trial steps do not move the rng streams (they are saved in checkpoints)
+        with torch.random.fork_rng():
+            lo, hi = 0, 1
+            while hi <= batch_size and fits(hi):
+                lo, hi = hi, hi * 2
+            hi = min(hi, batch_size + 1)
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                if fits(mid):
+                    lo = mid
+                else:
+                    hi = mid
+        if lo == 0:
+            raise RuntimeError(f'one segment of {segment_size} frames does not fit in {budget / 2 ** 30:.2f}GB')
+        if self.is_main:
+            print(f'Use micro_batch_size={lo}, {ceil(batch_size / lo)} micro-batches per batch of {batch_size}')
+        return lo
+
     def ae_step(self, data, lambda_kl):
-        x = cc(data)
-        mu, log_sigma, emb, dec = self.model(x)
-        criterion = nn.L1Loss()
-        loss_rec = criterion(dec, x)
-        loss_kl = 0.5 * torch.mean(torch.exp(log_sigma) + mu ** 2 - 1 - log_sigma)
-        loss = self.config['lambda']['lambda_rec'] * loss_rec + \
-                lambda_kl * loss_kl
+        # padded batches of the bucket sampler come with their lengths
+        if isinstance(data, (list, tuple)):
+            x, lengths = cc(data[0]), cc(data[1])
+        else:
+            x, lengths = cc(data), None
+        micro_batches = self.micro_batches(x, lengths)
         self.opt.zero_grad()
-        loss.backward()
-        grad_norm = torch.nn.utils.clip_grad_norm_(self.model.parameters(), 
-                max_norm=self.config['optimizer']['grad_norm'])
-        self.opt.step()
-        meta = {'loss_rec': loss_rec.item(),
-                'loss_kl': loss_kl.item(),
-                'grad_norm': grad_norm}
+        loss_rec, loss_kl = 0., 0.
+        for i, (micro_x, micro_lengths, weight) in enumerate(micro_batches):
+            # the gradients are averaged over the processes once, in the backward of the last micro-batch
+            last = i == len(micro_batches) - 1
+            with self.parallel_model.no_sync() if self.distributed and not last else nullcontext():
+                with self.timer('forward'):
+                    micro_loss_rec, micro_loss_kl = self.ae_loss(self.parallel_model, micro_x, micro_lengths)
+                    loss = self.config['lambda']['lambda_rec'] * micro_loss_rec + \
+                            lambda_kl * micro_loss_kl
+                with self.timer('backward'):
+                    self.scaler.scale(loss * weight).backward()
+            loss_rec += micro_loss_rec.item() * weight
+            loss_kl += micro_loss_kl.item() * weight
+        with self.timer('step'):
+            # clip the true gradients of the whole batch, not the scaled ones
+            self.scaler.unscale_(self.opt)
+            grad_norm = torch.nn.utils.clip_grad_norm_(self.model.parameters(), 
+                    max_norm=self.config['optimizer']['grad_norm'])
+            self.scaler.step(self.opt)
+            self.scaler.update()
+            meta = {'loss_rec': loss_rec,
+                    'loss_kl': loss_kl,
+                    'grad_norm': grad_norm.item()}
+            if lengths is not None:
+                meta['padding'] = 1 - lengths.sum().item() / (x.size(0) * x.size(2))
         return meta
 
+    def profile(self, iteration, end=False):
+        # torch profiler trace over [profile_start, profile_start + profile_steps)
+        if not self.is_main:
+            return
+        if iteration == self.args.profile_start and not end:
+            self.profiler = torch.profiler.profile(record_shapes=True)
+            self.profiler.__enter__()
+        elif self.profiler is not None and (end or iteration == self.args.profile_start + self.args.profile_steps):
+            self.profiler.__exit__(None, None, None)
+            trace_path = os.path.join(self.args.logdir, f'trace_{self.args.profile_start}.json')
+            self.profiler.export_chrome_trace(trace_path)
+            self.profiler = None
+            print(f'\nSaved profiler trace to {trace_path}')
+        return
+
+    def lambda_kl(self, iteration):
+        if iteration >= self.config['annealing_iters']:
+            return self.config['lambda']['lambda_kl']
+        else:
+            return self.config['lambda']['lambda_kl'] * (iteration + 1) / self.config['annealing_iters'] 
+
     def train(self, n_iterations):
-        for iteration in range(n_iterations):
-            if iteration >= self.config['annealing_iters']:
-                lambda_kl = self.config['lambda']['lambda_kl']
-            else:
-                lambda_kl = self.config['lambda']['lambda_kl'] * (iteration + 1) / self.config['annealing_iters'] 
-            data = next(self.train_iter)
+        # segments of all processes in one iteration
+        batch_size = self.config['data_loader']['batch_size'] * self.world_size
+        # (utterances, frames) of the recent variable-length batches
+        batch_sizes = deque(maxlen=1000)
+        for iteration in range(self.start_iteration, n_iterations):
+            self.profile(iteration)
+            start_time = time.time()
+            lambda_kl = self.lambda_kl(iteration)
+            with self.timer('data'):
+                data = next(self.train_iter)
+            if isinstance(data, (list, tuple)):
+                batch_sizes.append((data[1].size(0) * self.world_size, data[1].sum().item() * self.world_size))
+                batch_size = np.mean([n_utts for n_utts, _ in batch_sizes])
             meta = self.ae_step(data, lambda_kl)
-            # add to logger
-            if iteration % self.args.summary_steps == 0:
-                self.logger.scalars_summary(f'{self.args.tag}/ae_train', meta, iteration)
-            loss_rec = meta['loss_rec']
-            loss_kl = meta['loss_kl']
-
-            print(f'AE:[{iteration + 1}/{n_iterations}], loss_rec={loss_rec:.2f}, '
-                    f'loss_kl={loss_kl:.2f}, lambda={lambda_kl:.1e}     ', end='\r')
+            with self.timer('logging'):
+                # add to logger
+                if self.is_main and iteration % self.args.summary_steps == 0:
+                    self.logger.scalars_summary(f'{self.args.tag}/ae_train', meta, iteration)
+                    self.logger.timings_summary(f'{self.args.tag}/timing', self.timer, iteration, batch_size)
+                loss_rec = meta['loss_rec']
+                loss_kl = meta['loss_kl']
+
+                if self.is_main:
+                    throughput = f'{self.timer.throughput(batch_size):.1f} seg/s'
+                    if len(batch_sizes) > 0:
+                        n_frames = np.mean([n_frames for _, n_frames in batch_sizes])
+                        throughput += f', {self.timer.throughput(n_frames):.0f} frames/s, padding={meta["padding"]:.1%}'
+                    print(f'AE:[{iteration + 1}/{n_iterations}], loss_rec={loss_rec:.2f}, '
+                            f'loss_kl={loss_kl:.2f}, lambda={lambda_kl:.1e}, {throughput}     ', end='\r')
             if (iteration + 1) % self.args.save_steps == 0 or iteration + 1 == n_iterations:
-                self.save_model(iteration=iteration)
-                print()
+                with self.timer('checkpoint'):
+                    self.save_model(iteration=iteration)
+                if self.is_main:
+                    print()
+                    print(self.timer.summary())
+            self.timer.durations['iteration'].append(time.time() - start_time)
+        self.profile(n_iterations, end=True)
+        self.checkpointer.wait()
         return
 
@@ -0,0 +1,83 @@
+import os
+import json
+import hashlib
+import numpy as np
+from collections import OrderedDict
+
+def file_hash(path, block_size=1 << 20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+class SpeakerCache(object):
+    '''Speaker embeddings keyed by the hash of the target audio, the model checkpoint and the attr file.
+    Recently used embeddings are kept in memory (LRU), all of them are stored in cache_dir as .npy.
+    Named speakers are stored in cache_dir/speakers.json as name -> audio hash.
+    '''
+    def __init__(self, cache_dir, model_path, attr_path, capacity=128, variant=''):
+        self.cache_dir = cache_dir
+        self.capacity = capacity
+        # variant tells apart embeddings of the same checkpoint run differently (e.g. quantized)
+        self.model_hash = hashlib.sha1((file_hash(model_path) + file_hash(attr_path) + variant).encode()).hexdigest()
+        self.memory = OrderedDict()
+        self.speakers_path = os.path.join(cache_dir, 'speakers.json')
+        os.makedirs(cache_dir, exist_ok=True)
+        if os.path.exists(self.speakers_path):
+            with open(self.speakers_path, 'r') as f:
+                self.speakers = json.load(f)
+        else:
+            self.speakers = {}
+
+    def key(self, audio_hash):
+        return hashlib.sha1((self.model_hash + audio_hash).encode()).hexdigest()
+
+    def get(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        path = os.path.join(self.cache_dir, f'{key}.npy')
+        if not os.path.exists(path):
+            return None
+        emb = np.load(path)
+        self.put(key, emb, write=False)
+        return emb
+
+    def put(self, key, emb, write=True):
+        if write:
+            tmp_path = os.path.join(self.cache_dir, f'{key}.tmp.npy')
+            np.save(tmp_path, emb)
+            os.replace(tmp_path, os.path.join(self.cache_dir, f'{key}.npy'))
+        self.memory[key] = emb
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.capacity:
+            self.memory.popitem(last=False)
+
+    def get_or_compute(self, audio_path, compute_fn):
+        key = self.key(file_hash(audio_path))
+        emb = self.get(key)
+        if emb is None:
+            emb = compute_fn(audio_path)
+            self.put(key, emb)
+        return emb
+
+    def register(self, name, audio_path, compute_fn):
+        emb = self.get_or_compute(audio_path, compute_fn)
+        self.speakers[name] = {'audio_hash': file_hash(audio_path), 'path': os.path.abspath(audio_path)}
+        tmp_path = f'{self.speakers_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.speakers, f, indent=2)
+        os.replace(tmp_path, self.speakers_path)
+        return emb
+
+    def get_speaker(self, name, compute_fn=None):
+        if name not in self.speakers:
+            raise KeyError(f'speaker {name} is not registered in {self.cache_dir}')
+        emb = self.get(self.key(self.speakers[name]['audio_hash']))
+        if emb is None:
+            # registered with another model, recompute from the original audio if we can
+            if compute_fn is None or not os.path.exists(self.speakers[name]['path']):
+                raise KeyError(f'speaker {name} has no embedding for this model, register it again')
+            emb = self.register(name, self.speakers[name]['path'], compute_fn)
+        return emb
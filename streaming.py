@@ -0,0 +1,185 @@
+import time
+import yaml
+import torch
+import numpy as np
+from math import ceil
+from model import get_receptive_field
+from inference import Inferencer
+from inference import get_parser
+from preprocess.tacotron.hyperparams import Hyperparams as hp
+from preprocess.tacotron.frontend import get_frontend
+from preprocess.tacotron.griffin_lim import GriffinLim
+from preprocess.tacotron.audio import load_wav
+from preprocess.tacotron.audio import write_wav
+from preprocess.tacotron.audio import deemphasis
+from utils import cc
+
+class StreamingConverter(object):
+    '''Converts an audio stream block by block to a fixed target speaker.
+    process() accepts blocks of any number of samples as they arrive and returns the converted
+    samples that are ready (possibly none). Internally the stream is cut in blocks of block_frames
+    mel frames. A block is converted once lookahead frames after it are available: the model
+    sees [left context, block, lookahead] where the left context is the last half receptive field
+    of the encoder + decoder, so the buffers never hold more than that. The decoded block is
+    vocoded with Griffin-Lim together with gl_context frames on each side and crossfaded with the
+    previous block over crossfade samples. The output is the input timeline delayed by crossfade
+    samples, latency_samples is the algorithmic latency between an input sample and its output.
+    '''
+    def __init__(self, model, config, attr, emb, block_frames=8, lookahead=16,
+            n_iter=16, momentum=0.99, gl_context=4, crossfade=None):
+        self.model = model
+        self.attr = attr
+        self.emb = emb
+        total_subsample = int(np.prod(config['ContentEncoder']['subsample']))
+        round_up = lambda n: int(ceil(n / total_subsample)) * total_subsample
+        # block and windows have to stay on the subsampling grid
+        self.block_frames = round_up(block_frames)
+        self.lookahead = round_up(lookahead)
+        self.context = round_up(get_receptive_field(config['ContentEncoder'], config['Decoder']) / 2)
+        self.gl_context = min(gl_context, self.block_frames, self.lookahead)
+        self.frontend = get_frontend()
+        self.vocoder = GriffinLim(n_iter=n_iter, momentum=momentum)
+        self.hop_length = self.frontend.hop_length
+        self.n_fft = self.frontend.n_fft
+        self.crossfade = self.hop_length if crossfade is None else min(crossfade, self.gl_context * self.hop_length)
+        self.fade_in = np.linspace(0, 1, self.crossfade + 2, dtype=np.float32)[1:-1]
+        self.reset()
+
+    @property
+    def latency_samples(self):
+        # the first sample of a block waits for the end of the block, the lookahead frames,
+        # the half stft window of the last one and the crossfade
+        return (self.block_frames + self.lookahead - 1) * self.hop_length + self.n_fft // 2 + self.crossfade
+
+    @property
+    def latency(self):
+        return self.latency_samples / hp.sr
+
+    @property
+    def block_samples(self):
+        return self.block_frames * self.hop_length
+
+    def reset(self):
+        # the stream starts with n_fft // 2 zeros so that frame t is centered on sample t * hop_length
+        self.samples = np.zeros(self.n_fft // 2, dtype=np.float32)
+        self.last_sample = 0.
+        # normalized input frames from frame self.frames_start on
+        self.frames = np.zeros((0, self.frontend.mel_basis.size(0)), dtype=np.float32)
+        self.frames_start = 0
+        self.n_blocks = 0
+        # decoded frames before the next block, the left context of Griffin-Lim
+        self.decoded = None
+        self.tail = np.zeros(self.crossfade, dtype=np.float32)
+        self.last_output = 0.
+
+    def push_samples(self, y):
+        # pre-emphasis continued from the last sample, then every complete frame to log-mel
+        y = np.asarray(y, dtype=np.float32)
+        if len(y) == 0:
+            return
+        emphasized = np.append(y[0] - hp.preemphasis * self.last_sample, y[1:] - hp.preemphasis * y[:-1])
+        self.last_sample = y[-1]
+        self.samples = np.concatenate([self.samples, emphasized.astype(np.float32)])
+        n_frames = 1 + (len(self.samples) - self.n_fft) // self.hop_length if len(self.samples) >= self.n_fft else 0
+        if n_frames == 0:
+            return
+        with torch.no_grad():
+            mel = self.frontend.frames_to_mel(torch.from_numpy(self.samples).unsqueeze(0))[0].numpy()
+        self.samples = self.samples[n_frames * self.hop_length:]
+        self.frames = np.concatenate([self.frames, self.normalize(mel)])
+
+    def normalize(self, x):
+        return ((x - self.attr['mean']) / self.attr['std']).astype(np.float32)
+
+    def denormalize(self, x):
+        return x * self.attr['std'] + self.attr['mean']
+
+    def convert_block(self):
+        # frames [start, end) are converted, the window reaches back by context frames
+        start = self.n_blocks * self.block_frames
+        end = start + self.block_frames
+        window_start = max(start - self.context, 0)
+        offset = window_start - self.frames_start
+        window = self.frames[offset:end + self.lookahead - self.frames_start]
+        with torch.no_grad():
+            x = cc(torch.from_numpy(window.T.copy())).unsqueeze(0)
+            dec = self.model.inference_from_embedding(x, self.emb)
+        dec = self.denormalize(dec.squeeze(0).t().cpu().numpy())
+        dec = dec[start - window_start:]
+        # vocode [start - gl_context, end + gl_context), at the stream start without left context
+        left = self.decoded if self.decoded is not None else dec[:0]
+        mel = np.concatenate([left, dec[:self.block_frames + self.gl_context]])
+        with torch.no_grad():
+            mag = self.vocoder.mel_to_magnitude(torch.from_numpy(mel.astype(np.float32)).unsqueeze(0))
+            wav = self.vocoder.griffin_lim(mag)[0].numpy()
+        # wav[i] is sample (start - len(left)) * hop_length + i
+        begin = len(left) * self.hop_length
+        if len(left) > 0:
+            head = wav[begin - self.crossfade:begin]
+        else:
+            head = np.zeros(self.crossfade, dtype=np.float32)
+        body = wav[begin:begin + self.block_samples]
+        mixed = self.tail * self.fade_in[::-1] + head * self.fade_in
+        out = np.concatenate([mixed, body[:len(body) - self.crossfade]])
+        self.tail = body[len(body) - self.crossfade:]
+        # keep only what the next blocks need
+        self.decoded = dec[self.block_frames - self.gl_context:self.block_frames]
+        self.n_blocks += 1
+        drop = max(self.n_blocks * self.block_frames - self.context, 0) - self.frames_start
+        if drop > 0:
+            self.frames = self.frames[drop:]
+            self.frames_start += drop
+        # de-emphasis continued from the last output sample
+        out = deemphasis(out, hp.preemphasis, initial=self.last_output)
+        self.last_output = out[-1]
+        return out.astype(np.float32)
+
+    def process(self, y):
+        '''y: the next input samples, returns the next output samples'''
+        self.push_samples(y)
+        outputs = []
+        while self.frames_start + len(self.frames) >= (self.n_blocks + 1) * self.block_frames + self.lookahead:
+            outputs.append(self.convert_block())
+        return np.concatenate(outputs) if len(outputs) > 0 else np.zeros(0, dtype=np.float32)
+
+    def flush(self):
+        # pushes silence until every input sample has left the converter
+        return self.process(np.zeros(self.latency_samples + self.block_samples, dtype=np.float32))
+
+def stream(converter, y, input_block):
+    # feeds y in blocks of input_block samples, returns the output aligned with y
+    # and the processing time of every block
+    outputs, times = [], []
+    for i in range(0, len(y), input_block):
+        start_time = time.time()
+        outputs.append(converter.process(y[i:i + input_block]))
+        times.append(time.time() - start_time)
+    outputs.append(converter.flush())
+    out = np.concatenate(outputs)
+    return out[converter.crossfade:converter.crossfade + len(y)], times
+
+if __name__ == '__main__':
+    # simulates a live stream from a file:
+    # python3 streaming.py -c config.yaml -m model.ckpt -a attr.pkl -s src.wav -t tar.wav -o out.wav
+    parser = get_parser()
+    parser.add_argument('-block_frames', help='frames converted at once', default=8, type=int)
+    parser.add_argument('-lookahead', help='future frames seen by the model', default=16, type=int)
+    parser.add_argument('-gl_context', help='frames vocoded on each side of a block', default=4, type=int)
+    parser.add_argument('-input_block', help='samples per process() call', default=480, type=int)
+    parser.set_defaults(n_iter=16)
+    args = parser.parse_args()
+    with open(args.config) as f:
+        config = yaml.safe_load(f)
+    inferencer = Inferencer(config=config, args=args)
+    if args.speaker:
+        emb = inferencer.speaker_embedding_from_name(args.speaker)
+    else:
+        emb = inferencer.speaker_embedding_from_path(args.target)
+    converter = StreamingConverter(inferencer.model, config, inferencer.attr, emb,
+            block_frames=args.block_frames, lookahead=args.lookahead, n_iter=args.n_iter,
+            momentum=args.momentum, gl_context=args.gl_context)
+    y = load_wav(args.source, hp.sr)
+    out, times = stream(converter, y, args.input_block)
+    write_wav(args.output, out, args.sample_rate)
+    print(f'algorithmic latency={converter.latency * 1000:.1f}ms, '
+            f'real-time factor={sum(times) / (len(y) / hp.sr):.3f}')
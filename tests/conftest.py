@@ -0,0 +1,36 @@
+import os
+import sys
+import pickle
+import numpy as np
+import pytest
+import torch
+import yaml
+
+# the modules live at the top of the repository
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+@pytest.fixture(scope='session')
+def model_files(tmp_path_factory):
+    # a randomly initialized model and normalization attributes
+    path = tmp_path_factory.mktemp('model')
+    with open(os.path.join(root, 'config.yaml')) as f:
+        config = yaml.safe_load(f)
+    from model import AE
+    torch.manual_seed(0)
+    torch.save(AE(config).state_dict(), path / 'model.ckpt')
+    c_in = config['SpeakerEncoder']['c_in']
+    with open(path / 'attr.pkl', 'wb') as f:
+        pickle.dump({'mean': np.zeros(c_in, dtype=np.float32), 'std': np.ones(c_in, dtype=np.float32)}, f)
+    return config, path
+
+@pytest.fixture
+def make_inferencer(model_files):
+    from inference import Inferencer
+    from inference import get_parser
+    config, path = model_files
+    def make(*argv):
+        args = get_parser().parse_args(['-c', 'config.yaml', '-m', str(path / 'model.ckpt'), 
+            '-a', str(path / 'attr.pkl')] + list(argv))
+        return Inferencer(config=config, args=args)
+    return make
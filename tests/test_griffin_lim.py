@@ -0,0 +1,30 @@
+import numpy as np
+import torch
+from preprocess.tacotron.griffin_lim import GriffinLim
+from preprocess.tacotron.hyperparams import Hyperparams as hp
+
+def spectral_convergence(vocoder, mag, n_iter, momentum):
+    rebuilt = vocoder.stft(vocoder.griffin_lim(mag, n_iter=n_iter, momentum=momentum)).abs()
+    return (torch.norm(rebuilt - mag) / torch.norm(mag)).item()
+
+def test_fast_griffin_lim_converges_faster():
+    # one second of a harmonic tone
+    t = np.arange(hp.sr) / hp.sr
+    y = 0.3 * sum(np.sin(2 * np.pi * 220 * k * t) / k for k in range(1, 8))
+    vocoder = GriffinLim()
+    mag = vocoder.stft(torch.from_numpy(y.astype(np.float32))[None]).abs()
+    plain = spectral_convergence(vocoder, mag, n_iter=32, momentum=0)
+    fast = spectral_convergence(vocoder, mag, n_iter=32, momentum=0.99)
+    assert fast < 0.8 * plain
+    # fewer fast iterations are at least as good as the default number of plain ones
+    assert fast <= spectral_convergence(vocoder, mag, n_iter=hp.n_iter, momentum=0)
+
+def test_batch_matches_single():
+    rng = np.random.RandomState(0)
+    mels = [rng.rand(length, hp.n_mels).astype(np.float32) for length in [40, 90, 40]]
+    vocoder = GriffinLim(n_iter=4)
+    batch = vocoder(mels)
+    for mel, wav in zip(mels, batch):
+        single = vocoder.melspectrogram2wav(mel)
+        assert wav.shape == single.shape
+        assert np.abs(wav - single).max() < 1e-5
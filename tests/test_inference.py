@@ -0,0 +1,20 @@
+import numpy as np
+import pytest
+import torch
+
+def test_batch_matches_single_utterances(make_inferencer):
+    inferencer = make_inferencer()
+    torch.manual_seed(0)
+    mels = [torch.randn(length, 512) for length in [64, 400, 131, 77]]
+    embs = torch.randn(len(mels), 128)
+    with torch.no_grad():
+        decs = inferencer.convert_mel_batch(mels, embs)
+        for mel, emb, dec in zip(mels, embs, decs):
+            single = inferencer.convert_mel(mel, emb.unsqueeze(0))
+            assert dec.shape == single.shape
+            assert np.linalg.norm(dec - single) / np.linalg.norm(single) < 1e-4
+
+def test_speaker_requires_cache(make_inferencer):
+    inferencer = make_inferencer()
+    with pytest.raises(ValueError):
+        inferencer.speaker_embedding_from_name('speaker')
@@ -0,0 +1,13 @@
+import os
+from utils import AsyncCheckpointer
+
+def test_keep_ignores_newer_checkpoints_of_earlier_runs(tmp_path):
+    prefix = str(tmp_path / 'model')
+    # left behind by an earlier, longer run with the same prefix
+    open(f'{prefix}-100000.ckpt', 'w').close()
+    checkpointer = AsyncCheckpointer(keep=3)
+    for step in range(1, 6):
+        checkpointer.save(prefix, step, {'ckpt': {'step': step}})
+    checkpointer.wait()
+    assert sorted(os.listdir(tmp_path)) == ['model-100000.ckpt', 'model-3.ckpt', 'model-4.ckpt', 
+            'model-5.ckpt', 'model.ckpt', 'model.latest']
@@ -1,9 +1,17 @@
 import torch 
 import numpy as np
-from tensorboardX import SummaryWriter
-import editdistance
 import torch.nn as nn
 import torch.nn.init as init
+import os
+import re
+import copy
+import glob
+import time
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from collections import defaultdict
+from collections import deque
+from contextlib import contextmanager
 
 def cc(net):
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
@@ -11,6 +19,8 @@ def cc(net):
 
 class Logger(object):
     def __init__(self, logdir='./log'):
+        # only training writes summaries, inference does not need tensorboardX
+        from tensorboardX import SummaryWriter
         self.writer = SummaryWriter(logdir)
 
     def scalar_summary(self, tag, value, step):
@@ -25,6 +35,159 @@ class Logger(object):
     def audio_summary(self, tag, value, step, sr):
         writer.add_audio(tag, value, step, sample_rate=sr)
 
+    def close(self):
+        # flush the event file, the writer thread must not outlive a spawned process
+        self.writer.close()
+
+    def timings_summary(self, tag, timer, step, n_samples):
+        percentiles = timer.percentiles()
+        for stage, values in percentiles.items():
+            self.writer.add_scalars(f'{tag}/{stage}_ms', values, step)
+        self.writer.add_scalar(f'{tag}/segments_per_sec', timer.throughput(n_samples), step)
+
+class StageTimer(object):
+    '''Rolling wall-clock time of the stages of a training iteration.
+    with timer('forward'): ... also labels the block in torch profiler traces.
+    sync=True waits for cuda kernels at both ends, so the time is not charged to the next stage.
+    '''
+    def __init__(self, window=1000, sync=False):
+        self.sync = sync
+        self.durations = defaultdict(lambda: deque(maxlen=window))
+
+    @contextmanager
+    def __call__(self, stage):
+        if self.sync:
+            torch.cuda.synchronize()
+        start_time = time.time()
+        with torch.profiler.record_function(stage):
+            yield
+        if self.sync:
+            torch.cuda.synchronize()
+        self.durations[stage].append(time.time() - start_time)
+
+    def percentiles(self, qs=(50, 90, 99)):
+        ret = {}
+        for stage, durations in self.durations.items():
+            if len(durations) > 0:
+                values = np.percentile(np.array(durations) * 1000, qs)
+                ret[stage] = {f'p{q}': value for q, value in zip(qs, values)}
+        return ret
+
+    def throughput(self, n_samples):
+        # samples per second over the window of 'iteration'
+        durations = self.durations['iteration']
+        return n_samples * len(durations) / max(sum(durations), 1e-8)
+
+    def summary(self):
+        return ', '.join(f'{stage}={values["p50"]:.1f}ms' for stage, values in self.percentiles().items())
+
+def get_grad_scaler(enabled):
+    if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler('cuda', enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+class ActivationMemory(object):
+    '''Counts the bytes of the tensors saved for backward inside the context, 
+    i.e. the activation memory of a forward pass (parameters are not counted).
+    '''
+    def __enter__(self):
+        self.bytes = 0
+        self.data_ptrs = set()
+        self.hooks = torch.autograd.graph.saved_tensors_hooks(self.pack, lambda x: x)
+        self.hooks.__enter__()
+        return self
+
+    def pack(self, x):
+        if not isinstance(x, nn.Parameter) and x.data_ptr() not in self.data_ptrs:
+            self.data_ptrs.add(x.data_ptr())
+            self.bytes += x.numel() * x.element_size()
+        return x
+
+    def __exit__(self, *args):
+        self.hooks.__exit__(*args)
+
+def snapshot(state):
+    # copy of a (nested) state dict with every tensor copied to cpu memory
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    elif isinstance(state, dict):
+        return type(state)((key, snapshot(value)) for key, value in state.items())
+    elif isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value) for value in state)
+    return copy.deepcopy(state)
+
+def atomic_save(state, path):
+    # a crash while writing leaves the previous file at path untouched
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def atomic_write_text(text, path):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def atomic_link(src, dst):
+    # point dst to the file src (a hard link, a copy where links are not supported)
+    tmp_path = f'{dst}.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+class AsyncCheckpointer(object):
+    '''Writes checkpoints on a background thread.
+    save() copies the states to cpu memory and returns, then every state is written to 
+    <prefix>-<step>.<suffix> through a temporary file and os.replace. Only when all of them are written, 
+    <prefix>.latest (what --load_model reads) is set to step, so a crash never leaves a mixed set of 
+    states behind it, and <prefix>.<suffix> are pointed to the new files. The last keep numbered 
+    checkpoints are kept, keep=0 only the latest one. An error of the writer is raised by the next 
+    save() or wait().
+    '''
+    def __init__(self, keep=3):
+        self.keep = keep
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.future = None
+
+    def save(self, prefix, step, states):
+        # one write at a time, the snapshot of the next one waits for the previous write
+        self.wait()
+        states = [(suffix, snapshot(state)) for suffix, state in states.items()]
+        self.future = self.executor.submit(self.write, prefix, step, states)
+
+    def write(self, prefix, step, states):
+        for suffix, state in states:
+            atomic_save(state, f'{prefix}-{step}.{suffix}')
+        atomic_write_text(str(step), f'{prefix}.latest')
+        for suffix, _ in states:
+            atomic_link(f'{prefix}-{step}.{suffix}', f'{prefix}.{suffix}')
+        self.remove_old(prefix, step, [suffix for suffix, _ in states])
+
+    def remove_old(self, prefix, latest, suffixes):
+        # the steps up to latest, also of earlier runs with the same prefix. Higher steps are left to 
+        # the run that wrote them, they would otherwise push out the new checkpoints of this run
+        pattern = re.compile(re.escape(prefix) + r'-(\d+)\.')
+        steps = sorted(set(int(m.group(1)) for m in map(pattern.match, glob.glob(f'{glob.escape(prefix)}-*.*')) 
+            if m is not None and int(m.group(1)) <= latest))
+        for step in steps[:-max(self.keep, 1)]:
+            for suffix in suffixes:
+                if os.path.exists(f'{prefix}-{step}.{suffix}'):
+                    os.remove(f'{prefix}-{step}.{suffix}')
+
+    def wait(self):
+        if self.future is not None:
+            future, self.future = self.future, None
+            future.result()
+
 def infinite_iter(iterable):
     it = iter(iterable)
     while True:
@@ -32,4 +195,9 @@ def infinite_iter(iterable):
             ret = next(it)
             yield ret
         except StopIteration:
+            # reshuffle a ResumableSampler / DistributedSampler / BucketBatchSampler for the next pass,
+            # persistent workers are reused instead of started again
+            for sampler in [getattr(iterable, 'sampler', None), getattr(iterable, 'batch_sampler', None)]:
+                if hasattr(sampler, 'set_epoch'):
+                    sampler.set_epoch(sampler.epoch + 1)
             it = iter(iterable)